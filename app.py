@@ -1,14 +1,25 @@
+import asyncio
 import logging
 import uvicorn
 from contextlib import asynccontextmanager
 from fastapi_cache import FastAPICache
-from fastapi_cache.backends.inmemory import InMemoryBackend
 from starlette.middleware.cors import CORSMiddleware
 from config import CONFIG, LOGGING_CONFIG
 from fastapi import FastAPI, APIRouter
-from db.engine import AsyncSessionMaker, create_async_engine_wrapper, create_db_tables
+from db.engine import (
+    AsyncSessionMaker,
+    create_async_engine_wrapper,
+    create_db_tables,
+    is_schema_current,
+    replica_router,
+)
 from dependencies import Dependencies
-from redis_queue import create_redis_pool
+from funcs.cache_backend import TwoTierBackend
+from funcs.cache_funcs import warm_all_maps, route_reads_after_clear
+from funcs.resolution_index import resolution_index
+from funcs.outbox_funcs import run_outbox_dispatcher, stop_outbox_dispatcher
+from funcs.user_write_funcs import run_user_flusher, stop_user_flusher
+from redis_queue import create_redis_pool, create_cache_redis
 from routers.admin_api import admin_router
 from routers.grenade_api import grenade_router
 from routers.user_api import user_router
@@ -24,26 +35,63 @@ async def lifespan(application: FastAPI):
     # Подключение к БД
     logger.info("Connecting to DB...")
     engine = create_async_engine_wrapper(CONFIG.db)
-    await create_db_tables(engine)
+    if await is_schema_current(engine):
+        logger.info("DB schema is up to date, DDL skipped")
+    elif CONFIG.db.create_schema_on_startup:
+        await create_db_tables(engine)
+        logger.info("DB schema created")
+    else:
+        raise RuntimeError("DB schema is outdated, run create_schema.py")
     AsyncSessionMaker.configure(
         bind=engine
     )  # Подключаем sessionmaker к созданному движку
     logger.info("Db connected [DONE]")
 
-    # Подключение кэша
-    logger.info("Running im memory cache...")
-    FastAPICache.init(InMemoryBackend())
-    logger.info("In memory cache [DONE]")
+    if CONFIG.db.replica_hosts:
+        replica_router.configure(
+            [create_async_engine_wrapper(CONFIG.db, host) for host in CONFIG.db.replica_hosts],
+            lag_window=CONFIG.db.replica_lag_window,
+        )
+        logger.info(f"Read replicas: {len(CONFIG.db.replica_hosts)} [DONE]")
 
     # подключение к redis
     logger.info("Connecting to Redis...")
     Dependencies.queue = await create_redis_pool()
     logger.info("Redis pool initialized [DONE]")
 
+    # Подключение кэша: L1 в памяти воркера + общий L2 в redis
+    logger.info("Running two-tier cache...")
+    cache_backend = TwoTierBackend(
+        create_cache_redis(),
+        l1_expire=CONFIG.redis_db.cache_l1_expire,
+        l1_maxsize=CONFIG.redis_db.cache_l1_maxsize,
+    )
+    cache_backend.add_clear_listener(resolution_index.on_cache_clear)
+    cache_backend.add_clear_listener(route_reads_after_clear)
+    await cache_backend.start()
+    FastAPICache.init(cache_backend)
+    logger.info("Two-tier cache [DONE]")
+
+    # Прогрев кэша всех карт до того, как воркер начнёт принимать запросы
+    if CONFIG.redis_db.cache_warmup:
+        logger.info("Warming up map cache...")
+        await warm_all_maps(CONFIG.redis_db.cache_warmup_concurrency)
+        logger.info("Map cache warm-up [DONE]")
+
+    # Диспетчер outbox отправляет задачи на посты в arq и записывает результат
+    logger.info("Running outbox dispatcher...")
+    outbox_dispatcher = asyncio.create_task(run_outbox_dispatcher(Dependencies.queue))
+    logger.info("Outbox dispatcher [DONE]")
+
+    # Фоновая запись изменений юзеров пачками
+    user_flusher = asyncio.create_task(run_user_flusher())
+
     # print_logger_configs()
     yield
 
-    await FastAPICache.clear()
+    await stop_outbox_dispatcher(outbox_dispatcher)
+    await stop_user_flusher(user_flusher)
+    await cache_backend.close()
     logger.info("APP [STOPED]")
 
 
@@ -8,12 +8,27 @@ class DbConfig:
     password: str
     user: str
     database: str
+    pool_size: int
+    max_overflow: int
+    pool_timeout: int
+    pool_recycle: int
+    pool_pre_ping: bool
+    statement_cache_size: int  # размер кэша prepared statements на соединение, 0 - отключить
+    warm_statements: bool
+    replica_hosts: list[str]
+    replica_lag_window: int  # секунд после записи, когда чтение идёт в primary
+    create_schema_on_startup: bool  # False - схема создаётся только через create_schema.py
 
 
 @dataclass
 class RedisDB:
     port: int
     queue_db_index: int
+    cache_db_index: int
+    cache_l1_expire: int
+    cache_l1_maxsize: int
+    cache_warmup: bool  # прогрев кэша карт при старте и после инвалидации
+    cache_warmup_concurrency: int
 
 
 @dataclass
@@ -54,10 +69,25 @@ def load_config(path: str = None) -> Config:
             password=env.str("DB_PASS"),
             user=env.str("DB_USER"),
             database=env.str("DB_NAME"),
+            pool_size=env.int("DB_POOL_SIZE", 5),
+            max_overflow=env.int("DB_MAX_OVERFLOW", 10),
+            pool_timeout=env.int("DB_POOL_TIMEOUT", 30),
+            pool_recycle=env.int("DB_POOL_RECYCLE", -1),
+            pool_pre_ping=env.bool("DB_POOL_PRE_PING", False),
+            statement_cache_size=env.int("DB_STATEMENT_CACHE_SIZE", 100),
+            warm_statements=env.bool("DB_WARM_STATEMENTS", True),
+            replica_hosts=env.list("DB_REPLICA_HOSTS", []),
+            replica_lag_window=env.int("DB_REPLICA_LAG_WINDOW", 5),
+            create_schema_on_startup=env.bool("DB_CREATE_SCHEMA_ON_STARTUP", True),
         ),
         redis_db=RedisDB(
             port=env.int("REDIS_PORT"),
             queue_db_index=env.int("REDIS_QUEUE_INDEX"),
+            cache_db_index=env.int("REDIS_CACHE_INDEX", 2),
+            cache_l1_expire=env.int("CACHE_L1_EXPIRE", 60),
+            cache_l1_maxsize=env.int("CACHE_L1_MAXSIZE", 10000),
+            cache_warmup=env.bool("CACHE_WARMUP", False),
+            cache_warmup_concurrency=env.int("CACHE_WARMUP_CONCURRENCY", 3),
         ),
         admin_data=AdminData(
             username=env.str("ADMIN_USERNAME"),
@@ -0,0 +1,22 @@
+import asyncio
+import logging.config
+from config import CONFIG, LOGGING_CONFIG
+from db.engine import create_async_engine_wrapper, create_db_tables
+
+
+logger = logging.getLogger("lifespan")
+
+
+# Разовое создание/обновление схемы БД перед деплоем, воркеры при старте только сверяют отпечаток схемы
+async def main():
+    engine = create_async_engine_wrapper(CONFIG.db)
+    try:
+        await create_db_tables(engine)
+        logger.info("DB schema created [DONE]")
+    finally:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    logging.config.dictConfig(LOGGING_CONFIG)
+    asyncio.run(main())
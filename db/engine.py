@@ -1,18 +1,162 @@
+import hashlib
+import logging
+import time
+from dataclasses import dataclass
+from typing import Optional
+from sqlalchemy import event, Enum, select, Dialect
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import SQLAlchemyError, TimeoutError as PoolTimeoutError
 from sqlalchemy.ext.asyncio import (
     create_async_engine,
     AsyncEngine,
     AsyncSession,
     async_sessionmaker,
 )
-from sqlalchemy.sql.ddl import CreateSchema
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.util.queue import AsyncAdaptedQueue
+from sqlalchemy.sql import Executable
+from sqlalchemy.sql.ddl import CreateSchema, CreateTable, CreateIndex
 from sqlmodel import SQLModel
 from config import DbConfig
+from db.models import SchemaVersion
 
 
-def create_async_engine_wrapper(config: DbConfig) -> AsyncEngine:
-    return create_async_engine(
-        f"postgresql+asyncpg://{config.user}:{config.password}@{config.host}/{config.database}"
+logger = logging.getLogger("api_logger")
+
+# Запросы, которые подготавливаются на каждом новом соединении (см. prepare_on_connect)
+HOT_STATEMENTS: list[Executable] = []
+
+
+@dataclass
+class PoolWaitStats:
+    checkouts: int = 0
+    timeouts: int = 0
+    wait_total: float = 0.0
+    wait_max: float = 0.0
+
+
+class TimedQueue(AsyncAdaptedQueue):
+    """Очередь свободных соединений пула, считает только время ожидания в ней"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wait_stats = PoolWaitStats()
+
+    def get(self, block: bool = True, timeout: Optional[float] = None):
+        started = time.perf_counter()
+        try:
+            return super().get(block, timeout)
+        finally:
+            wait = time.perf_counter() - started
+            self.wait_stats.wait_total += wait
+            self.wait_stats.wait_max = max(self.wait_stats.wait_max, wait)
+
+
+class MonitoredQueuePool(AsyncAdaptedQueuePool):
+    """
+    Пул соединений со статистикой ожидания свободного соединения. Создание соединения и pre-ping
+    в ожидание не входят
+    """
+
+    _queue_class = TimedQueue
+
+    @property
+    def wait_stats(self) -> PoolWaitStats:
+        return self._pool.wait_stats
+
+    def connect(self):
+        try:
+            connection = super().connect()
+        except PoolTimeoutError:
+            self.wait_stats.timeouts += 1
+            raise
+
+        self.wait_stats.checkouts += 1
+        return connection
+
+
+def prepare_on_connect(stm: Executable) -> Executable:
+    HOT_STATEMENTS.append(stm)
+    return stm
+
+
+def warm_prepared_statements(engine: AsyncEngine) -> None:
+    # SQL компилируется тем же диалектом, поэтому текст совпадает с ключом кэша prepared statements asyncpg-адаптера
+    statements = [str(stm.compile(dialect=engine.dialect)) for stm in HOT_STATEMENTS]
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def prepare_statements(dbapi_connection, connection_record):
+        for statement in statements:
+            try:
+                dbapi_connection.await_(dbapi_connection._prepare(statement, 0))
+            except Exception as e:
+                # Например, при первом запуске, когда таблиц ещё нет
+                logger.warning(f"Statement warm-up skipped: {e!r}")
+                return
+
+
+def create_async_engine_wrapper(config: DbConfig, host: Optional[str] = None) -> AsyncEngine:
+    engine = create_async_engine(
+        f"postgresql+asyncpg://{config.user}:{config.password}@{host or config.host}/{config.database}",
+        poolclass=MonitoredQueuePool,
+        pool_size=config.pool_size,
+        max_overflow=config.max_overflow,
+        pool_timeout=config.pool_timeout,
+        pool_recycle=config.pool_recycle,
+        pool_pre_ping=config.pool_pre_ping,
+        connect_args={"prepared_statement_cache_size": config.statement_cache_size},
     )
+    if config.warm_statements and config.statement_cache_size:
+        warm_prepared_statements(engine)
+    return engine
+
+
+def get_pool_stats(engine: AsyncEngine) -> dict:
+    pool = engine.pool
+    stats = {
+        "size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "checked_in": pool.checkedin(),
+        "overflow": pool.overflow(),
+    }
+    wait_stats: PoolWaitStats | None = getattr(pool, "wait_stats", None)
+    if wait_stats:
+        stats.update(
+            checkouts=wait_stats.checkouts,
+            timeouts=wait_stats.timeouts,
+            wait_avg_ms=wait_stats.wait_total / wait_stats.checkouts * 1000 if wait_stats.checkouts else 0.0,
+            wait_max_ms=wait_stats.wait_max * 1000,
+        )
+    return stats
+
+
+def schema_fingerprint(dialect: Dialect) -> str:
+    ddl = []
+    for table in SQLModel.metadata.sorted_tables:
+        ddl.append(str(CreateTable(table).compile(dialect=dialect)))
+        ddl.extend(
+            str(CreateIndex(index).compile(dialect=dialect))
+            for index in sorted(table.indexes, key=lambda index: index.name)
+        )
+        # CREATE TABLE содержит только имя enum-типа, значения учитываются отдельно
+        ddl.extend(
+            f"{column.type.name}: {column.type.enums}" for column in table.columns if isinstance(column.type, Enum)
+        )
+    # Расширения, функции, триггеры и индексы, которые создаются вместе с таблицами
+    for listeners in (SQLModel.metadata.dispatch.before_create, SQLModel.metadata.dispatch.after_create):
+        ddl.extend(listener.statement for listener in listeners if hasattr(listener, "statement"))
+    return hashlib.sha256("\n".join(ddl).encode()).hexdigest()
+
+
+async def is_schema_current(async_engine: AsyncEngine) -> bool:
+    # Один запрос вместо проверки каждой таблицы и индекса в create_all(checkfirst=True)
+    try:
+        async with async_engine.connect() as conn:
+            fingerprint = (await conn.execute(select(SchemaVersion.fingerprint))).scalar()
+    except SQLAlchemyError:
+        # Таблицы schema_version ещё нет
+        return False
+    return fingerprint == schema_fingerprint(async_engine.dialect)
 
 
 async def create_db_tables(async_engine):
@@ -20,6 +164,11 @@ async def create_db_tables(async_engine):
         await conn.execute(CreateSchema("public", if_not_exists=True))
         await conn.run_sync(SQLModel.metadata.create_all, checkfirst=True)
 
+        fingerprint = schema_fingerprint(async_engine.dialect)
+        stm = insert(SchemaVersion).values(id=1, fingerprint=fingerprint)
+        stm = stm.on_conflict_do_update(index_elements=[SchemaVersion.id], set_={"fingerprint": fingerprint})
+        await conn.execute(stm)
+
 
 # Инициализация асинхронного sessionmaker
 AsyncSessionMaker = async_sessionmaker(
@@ -28,3 +177,107 @@ AsyncSessionMaker = async_sessionmaker(
     class_=AsyncSession,
     autoflush=False,
 )
+
+
+class ReplicaRouter:
+    """
+    Выбор реплики для читающих запросов по кругу. Недоступная реплика пропускается REPLICA_RETRY_AFTER секунд,
+    если доступных реплик нет - чтение идёт в primary
+    """
+
+    REPLICA_RETRY_AFTER = 30  # секунд
+
+    def __init__(self):
+        self.engines: list[AsyncEngine] = []
+        self.lag_window = 0
+        self._next = 0
+        self._down_until: dict[int, float] = {}
+        self._primary_until = 0.0
+        self._primary_users: dict[int, float] = {}
+
+    def configure(self, engines: list[AsyncEngine], lag_window: int) -> None:
+        self.engines = engines
+        self.lag_window = lag_window
+
+    def candidates(self) -> list[AsyncEngine]:
+        now = time.monotonic()
+        # Сразу после записи реплика может отставать, и устаревшие данные попадут в кэш или в ответ админу
+        if not self.engines or now < self._primary_until:
+            return []
+
+        start = self._next
+        self._next = (self._next + 1) % len(self.engines)
+        engines = self.engines[start:] + self.engines[:start]
+        return [engine for engine in engines if self._down_until.get(id(engine), 0.0) <= now]
+
+    def mark_down(self, engine: AsyncEngine) -> None:
+        self._down_until[id(engine)] = time.monotonic() + self.REPLICA_RETRY_AFTER
+
+    def hold_primary(self) -> None:
+        # После записи общих данных (карты, админка) lag_window секунд все чтения идут в primary
+        if self.engines:
+            self._primary_until = time.monotonic() + self.lag_window
+
+    def hold_primary_for_user(self, user_id: int) -> None:
+        # После записи данных юзера (избранное) в primary идут только его чтения
+        if not self.engines:
+            return
+        now = time.monotonic()
+        self._primary_users = {user: until for user, until in self._primary_users.items() if until > now}
+        self._primary_users[user_id] = now + self.lag_window
+
+    def is_primary_user(self, user_id: int) -> bool:
+        return self._primary_users.get(user_id, 0.0) > time.monotonic()
+
+
+replica_router = ReplicaRouter()
+
+
+class ReadSession(AsyncSession):
+    """
+    Сессия только для чтения. Реплика выбирается при первом запросе к БД, а не при открытии сессии,
+    поэтому ответы из кэша и 304 не занимают соединение
+    """
+
+    _routed = False
+
+    async def _route(self) -> None:
+        if self._routed:
+            return
+        self._routed = True
+
+        primary = self.bind
+        for engine in replica_router.candidates():
+            self.bind = engine
+            self.sync_session.bind = engine.sync_engine
+            try:
+                await self.connection()
+                return
+            except (OSError, SQLAlchemyError) as e:
+                await self.rollback()
+                replica_router.mark_down(engine)
+                logger.warning(f"Replica {engine.url.host} unavailable: {e!r}")
+
+        self.bind = primary
+        self.sync_session.bind = primary.sync_engine if primary is not None else None
+
+    async def execute(self, *args, **kwargs):
+        await self._route()
+        return await super().execute(*args, **kwargs)
+
+    async def scalar(self, *args, **kwargs):
+        await self._route()
+        return await super().scalar(*args, **kwargs)
+
+    async def get(self, *args, **kwargs):
+        await self._route()
+        return await super().get(*args, **kwargs)
+
+    async def stream(self, *args, **kwargs):
+        await self._route()
+        return await super().stream(*args, **kwargs)
+
+
+def open_read_session() -> ReadSession:
+    # Те же настройки, что у AsyncSessionMaker, bind по умолчанию - primary
+    return ReadSession(**AsyncSessionMaker.kw)
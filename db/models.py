@@ -11,6 +11,10 @@ from sqlalchemy import (
     ForeignKey,
     Integer,
     Boolean,
+    Index,
+    DDL,
+    event,
+    text,
 )
 from sqlalchemy.dialects.postgresql import JSONB, CITEXT
 from sqlalchemy.sql import expression
@@ -55,6 +59,23 @@ class ItemType(str, Enum):
     KEY_COMBO = "KEY_COMBO"
 
 
+class PostJobStatus(Enum):
+    PENDING = "PENDING"
+    ENQUEUED = "ENQUEUED"
+    DONE = "DONE"
+    FAILED = "FAILED"
+
+
+class PositionKind(str, Enum):
+    FINAL = "FINAL"
+    INITIAL = "INITIAL"
+
+
+class FavouriteAction(str, Enum):
+    ADD = "ADD"
+    REMOVE = "REMOVE"
+
+
 class EnumTypesPublic(BaseModel):
     grenade_types: list[str]
     grenade_sides: list[str]
@@ -310,6 +331,15 @@ class Grenade(GrenadeBase, table=True):
             "type",
             name="unique_grenade_data",
         ),
+        # Фильтрованная выдача опубликованных гранат с keyset-пагинацией по id (см. /grenade/get)
+        Index(
+            "ix_grenades_posted_map_type_side",
+            "map",
+            "type",
+            "side",
+            "id",
+            postgresql_where=text("tg_post_id IS NOT NULL"),
+        ),
         {"schema": "public"},
     )
 
@@ -401,6 +431,29 @@ class GrenadePublic(GrenadeBase):
         }
 
 
+class GrenadeTombstone(SQLModel, table=True):
+    """Удалённые гранаты и гранаты, ушедшие с карты. Заполняется триггером на grenades"""
+    __tablename__ = "grenade_tombstones"
+    __table_args__ = (
+        Index("ix_grenade_tombstones_map_delete_date", "map", "delete_date"),
+        {"schema": "public"},
+    )
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    grenade_id: int
+    map: CsMaps
+    delete_date: Optional[datetime] = Field(
+        default=None,
+        sa_column=Column(DateTime, server_default=func.now(), nullable=False),
+    )
+
+
+class GrenadeChangesPublic(BaseModel):
+    grenades: list[GrenadePublic]
+    deleted_ids: list[int]
+    cursor: datetime
+
+
 class NewGrenade(GrenadeBase):
     id: int
     map: CsMaps
@@ -412,6 +465,131 @@ class NewGrenade(GrenadeBase):
         use_enum_values = True
 
 
+# ------------------------------------------------- POST JOBS OUTBOX ---------------------------------------------------
+class GrenadePostJobBase(SQLModel):
+    grenade_id: int = Field(
+        sa_column=Column(
+            Integer,
+            ForeignKey("public.grenades.id", ondelete="CASCADE"),
+            nullable=False,
+            index=True,
+        )
+    )
+    function: str
+    status: PostJobStatus = Field(default=PostJobStatus.PENDING, index=True)
+    error: str | None = None
+    update_date: Optional[datetime] = Field(
+        default=None,
+        sa_column=Column(
+            DateTime,
+            default=func.now(),
+            server_default=func.now(),
+            onupdate=func.now(),
+            nullable=False,
+        ),
+    )
+
+
+class GrenadePostJob(GrenadePostJobBase, table=True):
+    """Outbox задач на пост в телеграм. Пишется в одной транзакции с гранатой, в arq отправляется диспетчером"""
+    __tablename__ = "grenade_post_jobs"
+    __table_args__ = {"schema": "public"}
+
+    id: int | None = Field(default=None, primary_key=True)
+    payload: Dict = Field(default_factory=dict, sa_column=Column(JSONB, nullable=False))
+
+
+class GrenadePostJobPublic(GrenadePostJobBase):
+    id: int
+
+
+# Триггеры пересоздаются идемпотентно при каждом create_all, после создания всех таблиц
+event.listen(
+    SQLModel.metadata,
+    "after_create",
+    DDL(
+        """
+        CREATE OR REPLACE FUNCTION public.add_grenade_tombstone() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO public.grenade_tombstones (grenade_id, map) VALUES (OLD.id, OLD.map);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """
+    ),
+)
+event.listen(
+    SQLModel.metadata,
+    "after_create",
+    DDL(
+        """
+        CREATE OR REPLACE TRIGGER grenade_tombstone_on_delete
+        AFTER DELETE ON public.grenades
+        FOR EACH ROW WHEN (OLD.map IS NOT NULL AND OLD.tg_post_id IS NOT NULL)
+        EXECUTE FUNCTION public.add_grenade_tombstone()
+        """
+    ),
+)
+event.listen(
+    SQLModel.metadata,
+    "after_create",
+    DDL(
+        """
+        CREATE OR REPLACE TRIGGER grenade_tombstone_on_hide
+        AFTER UPDATE OF map, tg_post_id ON public.grenades
+        FOR EACH ROW WHEN (
+            OLD.map IS NOT NULL AND OLD.tg_post_id IS NOT NULL
+            AND (OLD.map IS DISTINCT FROM NEW.map OR NEW.tg_post_id IS NULL)
+        )
+        EXECUTE FUNCTION public.add_grenade_tombstone()
+        """
+    ),
+)
+# create_all не добавляет индексы в уже существующие таблицы
+event.listen(SQLModel.metadata, "before_create", DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+event.listen(
+    SQLModel.metadata,
+    "after_create",
+    DDL(
+        """
+        CREATE INDEX IF NOT EXISTS ix_grenades_posted_map_type_side
+        ON public.grenades (map, type, side, id) WHERE tg_post_id IS NOT NULL
+        """
+    ),
+)
+# Триграммные индексы для /grenade/search. Выражения должны совпадать с выражениями в search_catalogue
+event.listen(
+    SQLModel.metadata,
+    "after_create",
+    DDL(
+        """
+        CREATE INDEX IF NOT EXISTS ix_map_positions_name_trgm
+        ON public.map_positions USING gin (name gin_trgm_ops)
+        """
+    ),
+)
+event.listen(
+    SQLModel.metadata,
+    "after_create",
+    DDL(
+        """
+        CREATE INDEX IF NOT EXISTS ix_key_combos_text_trgm
+        ON public.key_combos USING gin (CAST(text AS TEXT) gin_trgm_ops)
+        """
+    ),
+)
+event.listen(
+    SQLModel.metadata,
+    "after_create",
+    DDL(
+        """
+        CREATE INDEX IF NOT EXISTS ix_grenades_additional_info_trgm
+        ON public.grenades USING gin ((data ->> 'additional_info') gin_trgm_ops) WHERE tg_post_id IS NOT NULL
+        """
+    ),
+)
+
+
 # -------------------------------------------------- USER TABLE --------------------------------------------------------
 class UserChatData(BaseModel):
     user_ban_dt: Optional[int] = None
@@ -463,12 +641,75 @@ class NewUser(UserBase):
     chat_data: Optional[UserChatData] = Field(default_factory=lambda: UserChatData(user_ban_dt=None))
 
 
+# ------------------------------------------------- SCHEMA VERSION -----------------------------------------------------
+class SchemaVersion(SQLModel, table=True):
+    """Отпечаток схемы, с которой последний раз выполнялся create_all (см. db.engine.schema_fingerprint)"""
+    __tablename__ = "schema_version"
+    __table_args__ = {"schema": "public"}
+
+    id: int = Field(default=1, primary_key=True)
+    fingerprint: str
+    update_date: Optional[datetime] = Field(
+        default=None,
+        sa_column=Column(DateTime, server_default=func.now(), onupdate=func.now(), nullable=False),
+    )
+
+
 # ------------------------------------------------- PYDANTIC ---------------------------------------------------------
 class AdminDataResponse(BaseModel):
     map_positions: list[MapPositionPublic]
     key_combos: list[KeyCombo]
 
 
+class FavouriteOperation(BaseModel):
+    grenade_id: int
+    action: FavouriteAction
+
+
+class FavouriteBatch(BaseModel):
+    user_id: int
+    operations: list[FavouriteOperation] = Field(max_length=1000)
+
+
+class FavouriteOperationResult(FavouriteOperation):
+    applied: bool = Field(description="False - избранное уже было в нужном состоянии или граната не найдена")
+
+
+class GrenadeClusterPublic(BaseModel):
+    top: float
+    left: float
+    count: int
+    grenade_ids: list[int]
+
+    class Config:
+        from_attributes = True
+
+
+class NearestPositionPublic(BaseModel):
+    position: MapPositionPublic
+    distance: float = Field(description="Расстояние до точки в процентах карты")
+    grenades: list[GrenadePublic]
+
+
+class SearchResultPublic(BaseModel):
+    type: ItemType
+    id: int
+    text: str
+    map: CsMaps | None = None
+    score: float
+
+
+class PoolStatsPublic(BaseModel):
+    size: int
+    checked_out: int
+    checked_in: int
+    overflow: int
+    checkouts: int = 0
+    timeouts: int = 0
+    wait_avg_ms: float = 0.0
+    wait_max_ms: float = 0.0
+
+
 class DeleteQueryFilter(BaseModel):
     type: ItemType
     id: int
@@ -2,7 +2,7 @@ from typing import Annotated
 from arq import ArqRedis
 from fastapi import Depends
 from sqlalchemy.ext.asyncio import AsyncSession
-from db.engine import AsyncSessionMaker
+from db.engine import AsyncSessionMaker, open_read_session
 
 
 class Dependencies:
@@ -14,12 +14,19 @@ async def get_async_session() -> AsyncSession:
         yield session
 
 
+# Сессия только для чтения: реплика, если она настроена и доступна, иначе primary
+async def get_async_read_session() -> AsyncSession:
+    async with open_read_session() as session:
+        yield session
+
+
 # Зависимость для получения Redis-пула
 async def get_redis_pool() -> ArqRedis:
     return Dependencies.queue
 
 
 SessionDep = Annotated[AsyncSession, Depends(get_async_session)]
+ReadSessionDep = Annotated[AsyncSession, Depends(get_async_read_session)]
 QueueDep = Annotated[ArqRedis, Depends(get_redis_pool)]
 
 
@@ -0,0 +1,211 @@
+import asyncio
+import json
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from typing import Callable, Optional, Tuple
+from fastapi_cache.backends import Backend
+from redis.asyncio import Redis
+
+
+logger = logging.getLogger("api_logger")
+
+INVALIDATION_CHANNEL = "cs_guides:cache_invalidation"
+# Поколения ключей: растут при каждой очистке, по ним set узнаёт, что данные устарели, пока считались
+GENERATION_PREFIX = "cs_guides:cache_generation"
+NAMESPACE_GENERATION_KEY = f"{GENERATION_PREFIX}:namespace"
+GENERATION_EXPIRE = 3600  # секунд, дольше любого заполнения кэша
+# Значение записывается с полным TTL, только если поколения ключа и namespace-очисток не изменились
+# с промаха кэша. Иначе оно могло быть прочитано из БД до коммита и живёт только stale_fill_expire
+SET_IF_FRESH_SCRIPT = """
+local expire = tonumber(ARGV[2])
+if (redis.call('get', KEYS[2]) or '0') ~= ARGV[3] or (redis.call('get', KEYS[3]) or '0') ~= ARGV[4] then
+    expire = tonumber(ARGV[5])
+end
+if expire > 0 then
+    redis.call('set', KEYS[1], ARGV[1], 'EX', expire)
+else
+    redis.call('set', KEYS[1], ARGV[1])
+end
+return expire
+"""
+
+
+def generation_key(key: str) -> str:
+    return f"{GENERATION_PREFIX}:key:{key}"
+
+
+class TwoTierBackend(Backend):
+    """
+    Двухуровневый кэш: L1 - локальный LRU воркера, L2 - общий для всех воркеров Redis.
+    Очистка кэша рассылается через pub/sub, чтобы остальные воркеры сбросили свой L1
+    """
+
+    def __init__(self, redis: Redis, l1_expire: int = 60, l1_maxsize: int = 10000, stale_fill_expire: int = 60):
+        self.redis = redis
+        self.l1_expire = l1_expire  # страховка на случай потерянного сообщения об инвалидации
+        self.l1_maxsize = l1_maxsize
+        self.stale_fill_expire = stale_fill_expire
+        self._set_if_fresh = redis.register_script(SET_IF_FRESH_SCRIPT)
+        # key -> поколения (ключа, namespace-очисток) на момент промаха, с которого началось заполнение
+        self._fill_generations: dict[str, tuple[str, str]] = {}
+        self._store: OrderedDict[str, tuple[float, float, bytes]] = OrderedDict()
+        self._worker_id = uuid.uuid4().hex
+        self._listener: asyncio.Task | None = None
+        self._clear_listeners: list[Callable[[Optional[str], Optional[str]], None]] = []
+        # Растёт при каждой очистке L1. Значение, прочитанное из Redis во время очистки, в L1 не попадает
+        self._clear_seq = 0
+
+    def _get_local(self, key: str) -> Optional[Tuple[int, bytes]]:
+        item = self._store.get(key)
+        if item is None:
+            return None
+
+        expire_ts, local_expire_ts, value = item
+        now = time.monotonic()
+        if local_expire_ts < now:
+            del self._store[key]
+            return None
+
+        self._store.move_to_end(key)
+        # -1, как TTL в Redis для ключа без срока жизни
+        return (int(expire_ts - now) if expire_ts != float("inf") else -1), value
+
+    def _set_local(self, key: str, value: bytes, expire: Optional[int] = None) -> None:
+        now = time.monotonic()
+        expire_ts = now + expire if expire else float("inf")
+        local_expire_ts = min(expire_ts, now + self.l1_expire)
+        self._store[key] = (expire_ts, local_expire_ts, value)
+        self._store.move_to_end(key)
+        while len(self._store) > self.l1_maxsize:
+            self._store.popitem(last=False)
+
+    def add_clear_listener(self, callback: Callable[[Optional[str], Optional[str]], None]) -> None:
+        """Колбэк вызывается при каждой очистке кэша на любом воркере. namespace=None и key=None - сброс всего"""
+        self._clear_listeners.append(callback)
+
+    def _notify(self, namespace: Optional[str], key: Optional[str]) -> None:
+        for callback in self._clear_listeners:
+            callback(namespace, key)
+
+    def _clear_local(self, namespace: Optional[str] = None, key: Optional[str] = None) -> int:
+        self._clear_seq += 1
+        self._notify(namespace, key)
+
+        if namespace:
+            keys = [item for item in self._store if item.startswith(namespace)]
+        elif key:
+            keys = [key] if key in self._store else []
+        else:
+            keys = []
+
+        for item in keys:
+            del self._store[item]
+        return len(keys)
+
+    async def get_with_ttl(self, key: str) -> Tuple[int, Optional[bytes]]:
+        local = self._get_local(key)
+        if local is not None:
+            return local
+
+        clear_seq = self._clear_seq
+        async with self.redis.pipeline(transaction=True) as pipe:
+            ttl, value, generations = await pipe.ttl(key).get(key).mget(
+                generation_key(key), NAMESPACE_GENERATION_KEY
+            ).execute()
+        if value is None:
+            # При параллельных заполнениях одного ключа сохраняется самое раннее поколение
+            self._fill_generations.setdefault(
+                key, tuple(generation.decode() if generation else "0" for generation in generations)
+            )
+            return 0, None
+
+        if clear_seq == self._clear_seq:
+            self._set_local(key, value, ttl if ttl > 0 else None)
+        return ttl, value
+
+    async def get(self, key: str) -> Optional[bytes]:
+        _, value = await self.get_with_ttl(key)
+        return value
+
+    async def set(self, key: str, value: bytes, expire: Optional[int] = None) -> None:
+        # Без поколения (его уже забрало параллельное заполнение) значение считается устаревшим
+        key_generation, namespace_generation = self._fill_generations.pop(key, ("", ""))
+        expire = await self._set_if_fresh(
+            keys=[key, generation_key(key), NAMESPACE_GENERATION_KEY],
+            args=[value, expire or 0, key_generation, namespace_generation, self.stale_fill_expire],
+        )
+        self._set_local(key, value, expire or None)
+
+    async def clear(self, namespace: Optional[str] = None, key: Optional[str] = None) -> int:
+        if not namespace and not key:
+            return 0
+
+        # Поколение растёт до удаления: заполнение, начатое раньше, не запишет старые данные с полным TTL.
+        # Сначала Redis, потом L1: иначе параллельный get успеет вернуть в L1 старое значение из Redis
+        if namespace:
+            await self.redis.incr(NAMESPACE_GENERATION_KEY)
+            keys = [item async for item in self.redis.scan_iter(match=f"{namespace}*")]
+            count = await self.redis.delete(*keys) if keys else 0
+        else:
+            async with self.redis.pipeline(transaction=True) as pipe:
+                *_, count = await pipe.incr(generation_key(key)).expire(
+                    generation_key(key), GENERATION_EXPIRE
+                ).delete(key).execute()
+        self._clear_local(namespace, key)
+
+        await self.redis.publish(
+            INVALIDATION_CHANNEL,
+            json.dumps({"origin": self._worker_id, "namespace": namespace, "key": key}),
+        )
+        return count
+
+    async def signal(self, namespace: str) -> None:
+        """
+        Вызывает колбэки очистки с этим namespace на всех воркерах, сам кэш не трогает. Для сброса данных,
+        которые живут вне кэша (например, индексов в памяти воркера)
+        """
+        self._notify(namespace, None)
+        await self.redis.publish(
+            INVALIDATION_CHANNEL,
+            json.dumps({"origin": self._worker_id, "namespace": namespace, "key": None, "signal": True}),
+        )
+
+    async def start(self) -> None:
+        self._listener = asyncio.create_task(self._listen())
+
+    async def close(self) -> None:
+        if self._listener:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+        self._store.clear()
+        await self.redis.aclose()
+
+    async def _listen(self) -> None:
+        while True:
+            try:
+                async with self.redis.pubsub() as pubsub:
+                    await pubsub.subscribe(INVALIDATION_CHANNEL)
+                    # Пока подписки не было, сообщения могли потеряться
+                    self._clear_seq += 1
+                    self._store.clear()
+                    self._notify(None, None)
+                    async for message in pubsub.listen():
+                        if message["type"] != "message":
+                            continue
+                        data = json.loads(message["data"])
+                        if data["origin"] == self._worker_id:
+                            continue
+                        if data.get("signal"):
+                            self._notify(data["namespace"], data["key"])
+                        else:
+                            self._clear_local(data["namespace"], data["key"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Cache invalidation listener error: {e!r}")
+                await asyncio.sleep(1)
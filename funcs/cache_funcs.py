@@ -0,0 +1,423 @@
+import asyncio
+import gzip
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Optional
+import brotli
+import msgpack
+import orjson
+from fastapi_cache import FastAPICache
+from fastapi_cache.coder import PickleCoder
+from fastapi_cache.decorator import cache
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlmodel import select, and_
+from starlette import status
+from starlette.requests import Request
+from starlette.responses import Response
+from db.models import (
+    GrenadePublic,
+    Grenade,
+    CsMaps,
+    UserFavourite,
+    MapPosition,
+    KeyCombo,
+    AdminDataResponse,
+)
+from config import CONFIG
+from db.engine import AsyncSessionMaker, prepare_on_connect, replica_router
+from funcs.key_builder import custom_key_builder, map_cache_key, user_key_builder, user_cache_key
+from funcs.objects import CachedBody
+from funcs.resolution_index import pop_resolution_changes, apply_resolution_changes, RESOLUTION_INDEX_NAMESPACE
+
+logger = logging.getLogger("api_logger")
+
+# Кэш сбрасывается при каждой записи через commit_and_invalidate, поэтому TTL большой. Заполнение, которое
+# пересеклось с очисткой, записывается с коротким TTL (см. TwoTierBackend.set)
+MAP_CACHE_EXPIRE = 21600  # 6 часов
+MAP_CACHE_NAMESPACES = ("get_grenades", "get_grouped", "admin_data")
+FAVOURITES_CACHE_EXPIRE = 3600  # 1 час
+JSON_MEDIA_TYPE = "application/json"
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+MSGPACK_MEDIA_TYPES = (MSGPACK_MEDIA_TYPE, "application/x-msgpack")
+CONTENT_ENCODINGS = ("br", "gzip")  # в порядке предпочтения
+COMPRESS_MIN_SIZE = 1024  # байт, меньшие ответы не сжимаются
+# Тела кэша собираются и сжимаются в отдельных потоках, чтобы не держать event loop
+COMPRESS_WORKERS = 2
+compress_executor = ThreadPoolExecutor(max_workers=COMPRESS_WORKERS, thread_name_prefix="compress")
+
+
+def compress(body: bytes, encoding: str, fast: bool = False) -> bytes:
+    # fast - для ответов с избранным, которые сжимаются на каждый запрос.
+    # brotli 11 сжимает JSON карты около секунды, 9 - десятки мс при проигрыше в размере ~20%
+    if encoding == "br":
+        return brotli.compress(body, quality=4 if fast else 9)
+    return gzip.compress(body, compresslevel=1 if fast else 6, mtime=0)
+
+
+def build_cached_body(payload: Any) -> CachedBody:
+    # JSON, MessagePack, их сжатые варианты и ETag считаются один раз при заполнении кэша
+    body = orjson.dumps(payload)
+    cached = CachedBody(
+        etag=hashlib.blake2b(body, digest_size=16).hexdigest(),
+        body=body,
+        msgpack_body=msgpack.packb(payload),
+    )
+    if len(body) >= COMPRESS_MIN_SIZE:
+        for media_type in (JSON_MEDIA_TYPE, MSGPACK_MEDIA_TYPE):
+            for encoding in CONTENT_ENCODINGS:
+                cached.compressed[f"{media_type}:{encoding}"] = compress(get_cached_body(cached, media_type), encoding)
+    return cached
+
+
+async def make_cached_body(payload: Any) -> CachedBody:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(compress_executor, build_cached_body, payload)
+
+
+# Запросы при промахе кэша подготавливаются заранее на каждом соединении пула.
+# Значения параметров не важны, ключ кэша prepared statements - текст SQL
+def map_grenades_statement(map_name: CsMaps):
+    return select(Grenade).where(
+        and_(Grenade.map == map_name.value, Grenade.tg_post_id.is_not(None))
+    )
+
+
+def map_positions_statement(map_name: CsMaps):
+    return select(MapPosition).where(MapPosition.map == map_name.value)
+
+
+def user_favourites_statement(user_id: int):
+    return (
+        select(Grenade.map, UserFavourite.grenade_id)
+        .join(Grenade, Grenade.id == UserFavourite.grenade_id)
+        .where(UserFavourite.user_id == user_id)
+    )
+
+
+prepare_on_connect(map_grenades_statement(CsMaps.MIRAGE))
+prepare_on_connect(map_positions_statement(CsMaps.MIRAGE))
+prepare_on_connect(user_favourites_statement(0))
+
+
+# Кэшируется общий для всех юзеров список гранат карты, без флагов избранного.
+# Флаги накладываются поверх для каждого юзера отдельно (см. apply_favourites)
+@cache(
+    expire=MAP_CACHE_EXPIRE,
+    namespace="get_grenades",
+    coder=PickleCoder,
+    key_builder=custom_key_builder,
+)
+async def get_map_grenades(map_name: CsMaps, session: AsyncSession) -> CachedBody:
+    stm = map_grenades_statement(map_name)
+    return await make_cached_body(
+        [
+            GrenadePublic.model_validate(grenade).model_dump(mode="json")
+            for grenade in (await session.execute(stm)).scalars().all()
+        ]
+    )
+
+
+@cache(
+    expire=MAP_CACHE_EXPIRE,
+    namespace="get_grouped",
+    coder=PickleCoder,
+    key_builder=custom_key_builder,
+)
+async def get_map_grouped_grenades(map_name: CsMaps, session: AsyncSession) -> CachedBody:
+    dict_of_grenades: dict[str, dict[str, dict]] = {}
+    cached = await get_map_grenades(map_name=map_name, session=session)
+    for grenade in orjson.loads(cached.body):
+        position = grenade["final_position"]["position"]
+        key = f"{position['top']}_{position['left']}"
+        dict_of_grenades.setdefault(key, {})[str(grenade["id"])] = grenade
+
+    return await make_cached_body(dict_of_grenades)
+
+
+@cache(
+    expire=MAP_CACHE_EXPIRE,
+    namespace="admin_data",
+    coder=PickleCoder,
+    key_builder=custom_key_builder,
+)
+async def get_admin_data(map_name: CsMaps, session: AsyncSession) -> CachedBody:
+    stm = map_positions_statement(map_name)
+    map_positions = (await session.execute(stm)).scalars().all()
+
+    key_combos = (await session.execute(select(KeyCombo))).scalars().all()
+
+    return await make_cached_body(
+        AdminDataResponse(map_positions=map_positions, key_combos=key_combos).model_dump(mode="json")
+    )
+
+
+# Все избранные гранаты юзера, сгруппированные по картам: {map: [grenade_id, ...]}
+@cache(
+    expire=FAVOURITES_CACHE_EXPIRE,
+    namespace="favourites",
+    coder=PickleCoder,
+    key_builder=user_key_builder,
+)
+async def get_user_favourites(user_id: int, session: AsyncSession) -> dict[str, list[int]]:
+    stm = user_favourites_statement(user_id)
+    favourites: dict[str, list[int]] = {}
+    for map_name, grenade_id in (await session.execute(stm)).all():
+        favourites.setdefault(CsMaps(map_name).value, []).append(grenade_id)
+
+    return favourites
+
+
+async def get_favourite_ids(user_id: int, map_name: CsMaps | None, session: AsyncSession) -> set[int]:
+    if user_id < 0:
+        return set()
+
+    if replica_router.is_primary_user(user_id):
+        # Юзер только что менял избранное, реплика может ещё не догнать
+        async with AsyncSessionMaker() as primary_session:
+            favourites = await get_user_favourites(user_id=user_id, session=primary_session)
+    else:
+        favourites = await get_user_favourites(user_id=user_id, session=session)
+    if map_name is None:
+        return {grenade_id for grenade_ids in favourites.values() for grenade_id in grenade_ids}
+    return set(favourites.get(map_name.value, []))
+
+
+async def invalidate_user_favourites(user_id: int) -> None:
+    await FastAPICache.clear(key=user_cache_key("favourites", user_id))
+
+
+def route_reads_after_clear(namespace: Optional[str], key: Optional[str]) -> None:
+    """
+    Колбэк очистки кэша (на любом воркере): после записи чтения на время lag_window уходят в primary.
+    Полный сброс при подключении к pub/sub записью не является
+    """
+    if key:
+        # Ключ вида "{prefix}:{namespace}:{значение}"
+        _, namespace, value = key.rsplit(":", 2)
+        if namespace == "favourites":
+            replica_router.hold_primary_for_user(int(value))
+            return
+    elif namespace:
+        namespace = namespace.rsplit(":", 1)[-1]
+    else:
+        return
+
+    if namespace in (*MAP_CACHE_NAMESPACES, RESOLUTION_INDEX_NAMESPACE):
+        replica_router.hold_primary()
+
+
+def loads(body: bytes, media_type: str) -> Any:
+    return msgpack.unpackb(body) if media_type == MSGPACK_MEDIA_TYPE else orjson.loads(body)
+
+
+def dumps(payload: Any, media_type: str) -> bytes:
+    return msgpack.packb(payload) if media_type == MSGPACK_MEDIA_TYPE else orjson.dumps(payload)
+
+
+def get_cached_body(cached: CachedBody, media_type: str) -> bytes:
+    if media_type != MSGPACK_MEDIA_TYPE:
+        return cached.body
+    # В кэше могут остаться записи без MessagePack-варианта
+    return cached.msgpack_body or msgpack.packb(orjson.loads(cached.body))
+
+
+def get_compressed_body(cached: CachedBody, media_type: str, encoding: str) -> bytes:
+    # В кэше могут остаться записи без сжатых вариантов
+    compressed = getattr(cached, "compressed", {}).get(f"{media_type}:{encoding}")
+    return compressed or compress(get_cached_body(cached, media_type), encoding, fast=True)
+
+
+def get_quality(params: list[str]) -> float:
+    # q из параметров Accept/Accept-Encoding, по умолчанию 1
+    for param in params:
+        name, _, value = param.partition("=")
+        if name.strip().lower() == "q":
+            try:
+                return float(value)
+            except ValueError:
+                return 0.0
+    return 1.0
+
+
+def negotiate_encoding(request: Request) -> Optional[str]:
+    accepted = {}
+    for coding in request.headers.get("accept-encoding", "").split(","):
+        coding, *params = (part.strip() for part in coding.split(";"))
+        accepted[coding.lower()] = get_quality(params) > 0
+
+    for encoding in CONTENT_ENCODINGS:
+        if accepted.get(encoding, accepted.get("*", False)):
+            return encoding
+    return None
+
+
+def negotiate_media_type(request: Request) -> str:
+    # MessagePack отдаётся только тем клиентам, которые явно его запросили, иначе JSON
+    for media_range in request.headers.get("accept", "").split(","):
+        media_type, *params = (part.strip() for part in media_range.split(";"))
+        if media_type.lower() in MSGPACK_MEDIA_TYPES and get_quality(params) > 0:
+            return MSGPACK_MEDIA_TYPE
+    return JSON_MEDIA_TYPE
+
+
+def apply_favourites(
+    body: bytes,
+    favourite_ids: set[int],
+    grouped: bool = False,
+    media_type: str = JSON_MEDIA_TYPE,
+) -> bytes:
+    # Если на карте нет избранного, байты из кэша отдаются без разбора
+    if not favourite_ids:
+        return body
+
+    payload = loads(body, media_type)
+    grenades = (
+        (grenade for group in payload.values() for grenade in group.values())
+        if grouped
+        else payload
+    )
+    for grenade in grenades:
+        grenade["is_favourite"] = grenade["id"] in favourite_ids
+
+    return dumps(payload, media_type)
+
+
+def make_etag(
+    cached: CachedBody,
+    favourite_ids: set[int],
+    media_type: str = JSON_MEDIA_TYPE,
+    encoding: Optional[str] = None,
+) -> str:
+    # У каждого представления и сжатия свой ETag, иначе клиент получит 304 на закэшированный ответ в другом формате
+    etag = cached.etag if media_type == JSON_MEDIA_TYPE else f"{cached.etag}-mp"
+    if encoding:
+        etag = f"{etag}-{encoding}"
+    if not favourite_ids:
+        return f'"{etag}"'
+
+    favourites = ",".join(str(grenade_id) for grenade_id in sorted(favourite_ids))
+    return f'"{etag}-{hashlib.blake2b(favourites.encode(), digest_size=8).hexdigest()}"'
+
+
+def is_not_modified(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+
+    return if_none_match.strip() == "*" or etag in (
+        tag.strip().removeprefix("W/") for tag in if_none_match.split(",")
+    )
+
+
+def make_cached_response(
+    request: Request,
+    cached: CachedBody,
+    favourite_ids: set[int] | None = None,
+    grouped: bool = False,
+) -> Response:
+    favourite_ids = favourite_ids or set()
+    media_type = negotiate_media_type(request)
+    encoding = negotiate_encoding(request) if len(cached.body) >= COMPRESS_MIN_SIZE else None
+    etag = make_etag(cached, favourite_ids, media_type, encoding)
+    # no-cache: клиент хранит ответ, но каждый раз сверяет его с сервером через If-None-Match
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept, Accept-Encoding"}
+
+    if is_not_modified(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    if favourite_ids:
+        # Ответ с избранным свой у каждого юзера, его приходится сжимать на лету
+        content = apply_favourites(get_cached_body(cached, media_type), favourite_ids, grouped, media_type)
+        if encoding:
+            content = compress(content, encoding, fast=True)
+    elif encoding:
+        content = get_compressed_body(cached, media_type, encoding)
+    else:
+        content = get_cached_body(cached, media_type)
+
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    # Content-Length Response выставляет сам по длине content
+    return Response(content=content, media_type=media_type, headers=headers)
+
+
+def mark_map_changed(session: AsyncSession, map_name: CsMaps | str) -> None:
+    session.info.setdefault("changed_maps", set()).add(CsMaps(map_name))
+
+
+# Комбинации клавиш общие для всех карт, поэтому сбрасываются данные админки всех карт
+def mark_key_combos_changed(session: AsyncSession) -> None:
+    session.info["key_combos_changed"] = True
+
+
+async def invalidate_map_cache(map_name: CsMaps) -> None:
+    for namespace in MAP_CACHE_NAMESPACES:
+        await FastAPICache.clear(key=map_cache_key(namespace, map_name))
+
+
+# Кэш карт сбрасывается только после коммита, иначе параллельный запрос успеет закэшировать старые данные
+async def commit_and_invalidate(session: AsyncSession) -> None:
+    changed_maps: set[CsMaps] = session.info.pop("changed_maps", set())
+    key_combos_changed = session.info.pop("key_combos_changed", False)
+    resolution_changes = pop_resolution_changes(session)
+    await session.commit()
+
+    await apply_resolution_changes(resolution_changes)
+    for map_name in changed_maps:
+        await invalidate_map_cache(map_name)
+        schedule_map_warmup(map_name)
+    if key_combos_changed:
+        # По ключам, как и кэш карт: очистка namespace сканирует весь Redis кэша
+        for map_name in CsMaps:
+            await FastAPICache.clear(key=map_cache_key("admin_data", map_name))
+
+
+async def warm_map_cache(map_name: CsMaps) -> None:
+    # Сессия к primary: прогрев идёт сразу после коммита, реплика может ещё не догнать
+    async with AsyncSessionMaker() as session:
+        # Заполняет и get_grouped, и get_grenades, из которого он строится
+        await get_map_grouped_grenades(map_name=map_name, session=session)
+
+
+async def warm_all_maps(concurrency: int) -> None:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def warm(map_name: CsMaps) -> None:
+        async with semaphore:
+            try:
+                await warm_map_cache(map_name)
+            except Exception as e:
+                logger.error(f"Cache warm-up error [{map_name.value}]: {e!r}")
+
+    await asyncio.gather(*(warm(map_name) for map_name in CsMaps))
+
+
+_warmup_tasks: dict[CsMaps, asyncio.Task] = {}
+_warmup_again: set[CsMaps] = set()
+
+
+def schedule_map_warmup(map_name: CsMaps) -> None:
+    if not CONFIG.redis_db.cache_warmup:
+        return
+
+    task = _warmup_tasks.get(map_name)
+    if task is not None and not task.done():
+        # Идущий прогрев мог прочитать данные до нового коммита, после него карта прогревается ещё раз
+        _warmup_again.add(map_name)
+        return
+    _warmup_tasks[map_name] = asyncio.create_task(warm_map_in_background(map_name))
+
+
+async def warm_map_in_background(map_name: CsMaps) -> None:
+    while True:
+        _warmup_again.discard(map_name)
+        try:
+            await warm_map_cache(map_name)
+        except Exception as e:
+            logger.error(f"Cache warm-up error [{map_name.value}]: {e!r}")
+
+        if map_name not in _warmup_again:
+            return
+        # Устаревшие данные из предыдущего прогона уже в кэше, @cache вернёт их без пересчёта
+        await invalidate_map_cache(map_name)
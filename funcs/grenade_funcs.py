@@ -1,8 +1,10 @@
 import logging
 from fastapi import HTTPException
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlmodel import update, delete
+from sqlalchemy import Text, literal, literal_column, union_all, null, cast
+from sqlmodel import update, delete, select, distinct, func, and_, or_
 from starlette import status
 from db.models import (
     NewGrenade,
@@ -11,6 +13,18 @@ from db.models import (
     MapPosition,
     NewKeyCombo,
     KeyCombo,
+    CsMaps,
+    ItemType,
+    SearchResultPublic,
+)
+from funcs.cache_funcs import mark_map_changed, mark_key_combos_changed
+from funcs.resolution_index import (
+    resolution_index,
+    map_position_key,
+    key_combo_key,
+    remember_position,
+    remember_key_combo,
+    mark_resolution_index_stale,
 )
 
 
@@ -29,11 +43,22 @@ async def add_map_position(new_map_position: NewMapPosition, session: AsyncSessi
                    f"position: {new_map_position.position}, name: {new_map_position.name}",
         )
 
-    map_position = MapPosition.model_validate(new_map_position)
+    key = map_position_key(new_map_position.map, new_map_position.position)
+    map_position_id = await resolution_index.get_position_id(new_map_position.map, new_map_position.position, session)
+    if map_position_id:
+        return map_position_id
+
+    stm = insert(MapPosition).values(new_map_position.model_dump(include={"map", "name", "position"}))
+    stm = stm.on_conflict_do_update(
+        constraint="unique_position",
+        # Существующее название не перезаписываем, DO UPDATE нужен, чтобы RETURNING вернул и старую строку
+        set_={"name": func.coalesce(MapPosition.name, stm.excluded.name)},
+    ).returning(MapPosition.id)
     try:
-        session.add(map_position)
-        await session.flush()
-        return map_position.id
+        map_position_id = (await session.execute(stm)).scalar()
+        remember_position(session, key, map_position_id)
+        mark_map_changed(session, new_map_position.map)
+        return map_position_id
     except IntegrityError as e:
         await session.rollback()
         logging.error(e.orig.__repr__())
@@ -48,17 +73,23 @@ async def update_map_position(map_position: MapPosition, session: AsyncSession)
         update(MapPosition)
         .values(map_position.model_dump(exclude_none=True))
         .where(MapPosition.id == map_position.id)
-        .returning(MapPosition.id)
+        .returning(MapPosition.id, MapPosition.map)
     )
-    map_position_id = (await session.execute(stm)).scalar()
+    row = (await session.execute(stm)).first()
 
-    if not map_position_id:
+    if not row:
         await session.rollback()
         raise HTTPException(
             status_code=status.HTTP_304_NOT_MODIFIED,
-            detail=f"Map position [ID: {map_position_id} не найдена",
+            detail=f"Map position [ID: {map_position.id} не найдена",
         )
 
+    map_position_id, map_name = row
+    await touch_grenades(
+        or_(Grenade.initial_position_id == map_position_id, Grenade.final_position_id == map_position_id), session
+    )
+    mark_map_changed(session, map_name)
+    mark_resolution_index_stale(session)
     return map_position_id
 
 
@@ -66,26 +97,43 @@ async def delete_map_position(map_position_id: int, session: AsyncSession) -> in
     stm = (
         delete(MapPosition)
         .where(MapPosition.id == map_position_id)
-        .returning(MapPosition.id)
+        .returning(MapPosition.id, MapPosition.map)
     )
-    map_position_id = (await session.execute(stm)).scalar()
-    if not map_position_id:
+    row = (await session.execute(stm)).first()
+    if not row:
         await session.rollback()
         raise HTTPException(
             status_code=status.HTTP_304_NOT_MODIFIED,
             detail=f"Map position [ID: {map_position_id} не найдена",
         )
 
+    map_position_id, map_name = row
+    mark_map_changed(session, map_name)
+    mark_resolution_index_stale(session)
     return map_position_id
 
 
 async def add_key_combo(new_key_combo: NewKeyCombo, session: AsyncSession) -> int:
-    key_combo = KeyCombo.model_validate(new_key_combo)
+    if not new_key_combo.text:
+        raise HTTPException(
+            status_code=status.HTTP_304_NOT_MODIFIED,
+            detail="Не хватает полей в key_combo",
+        )
 
+    key_combo_id = await resolution_index.get_key_combo_id(new_key_combo.text, session)
+    if key_combo_id:
+        return key_combo_id
+
+    stm = insert(KeyCombo).values(text=new_key_combo.text)
+    stm = stm.on_conflict_do_update(
+        index_elements=[KeyCombo.text],
+        set_={"text": KeyCombo.text},
+    ).returning(KeyCombo.id)
     try:
-        session.add(key_combo)
-        await session.flush()
-        return key_combo.id
+        key_combo_id = (await session.execute(stm)).scalar()
+        remember_key_combo(session, key_combo_key(new_key_combo.text), key_combo_id)
+        mark_key_combos_changed(session)
+        return key_combo_id
     except IntegrityError as e:
         await session.rollback()
         logging.error(e.orig.__repr__())
@@ -94,6 +142,18 @@ async def add_key_combo(new_key_combo: NewKeyCombo, session: AsyncSession) -> in
         )
 
 
+# Позиции и комбо встроены в выдачу гранат, поэтому их изменение двигает update_date гранат для /grenade/changes
+async def touch_grenades(condition, session: AsyncSession) -> set[str]:
+    stm = update(Grenade).where(condition).values(update_date=func.now()).returning(Grenade.map)
+    return set((await session.execute(stm)).scalars().all())
+
+
+async def mark_key_combo_maps_changed(key_combo_id: int, session: AsyncSession) -> None:
+    stm = select(distinct(Grenade.map)).where(Grenade.key_combo_id == key_combo_id)
+    for map_name in (await session.execute(stm)).scalars().all():
+        mark_map_changed(session, map_name)
+
+
 async def update_key_combo(key_combo: KeyCombo, session: AsyncSession) -> int:
     stm = (
         update(KeyCombo)
@@ -110,10 +170,17 @@ async def update_key_combo(key_combo: KeyCombo, session: AsyncSession) -> int:
             detail=f"Key combo [ID: {key_combo_id} не найдено",
         )
 
+    for map_name in await touch_grenades(Grenade.key_combo_id == key_combo_id, session):
+        if map_name:
+            mark_map_changed(session, map_name)
+    mark_key_combos_changed(session)
+    mark_resolution_index_stale(session)
     return key_combo_id
 
 
 async def delete_key_combo(key_combo_id: int, session: AsyncSession) -> int:
+    # Гранаты удаляются каскадом, поэтому их карты нужно найти до удаления комбо
+    await mark_key_combo_maps_changed(key_combo_id, session)
     stm = (
         delete(KeyCombo)
         .where(KeyCombo.id == key_combo_id)
@@ -128,6 +195,8 @@ async def delete_key_combo(key_combo_id: int, session: AsyncSession) -> int:
             detail=f"Key combo [ID: {key_combo_id} не найдено",
         )
 
+    mark_key_combos_changed(session)
+    mark_resolution_index_stale(session)
     return key_combo_id
 
 
@@ -179,6 +248,7 @@ async def add_or_update_grenade(
         key_combo_id=key_combo_id,
     )
 
+    old_map = (await session.execute(select(Grenade.map).where(Grenade.id == new_grenade.id))).scalar()
     stm = (
         update(Grenade)
         .values(grenade_dumped)
@@ -195,5 +265,187 @@ async def add_or_update_grenade(
         )
     await session.flush()
 
+    mark_map_changed(session, new_grenade.map)
+    if old_map:
+        mark_map_changed(session, old_map)
+
     grenade = await session.get(Grenade, grenade_id)
     return grenade
+
+
+def check_new_map_position(new_map_position: NewMapPosition) -> None:
+    if not all((new_map_position.map, new_map_position.position, new_map_position.name)):
+        raise HTTPException(
+            status_code=status.HTTP_304_NOT_MODIFIED,
+            detail=f"Не хватает полей в map_position. map: {new_map_position.map}, "
+                   f"position: {new_map_position.position}, name: {new_map_position.name}",
+        )
+
+
+async def bulk_upsert_map_positions(
+    new_map_positions: list[NewMapPosition], session: AsyncSession
+) -> dict[tuple, int]:
+    position_ids = {}
+    # Одинаковые позиции схлопываются, иначе ON CONFLICT DO UPDATE упадёт на повторной строке
+    rows = {}
+    for new_map_position in new_map_positions:
+        key = map_position_key(new_map_position.map, new_map_position.position)
+        map_position_id = await resolution_index.get_position_id(
+            new_map_position.map, new_map_position.position, session
+        )
+        if map_position_id:
+            position_ids[key] = map_position_id
+        else:
+            rows[key] = new_map_position.model_dump(include={"map", "name", "position"})
+    if not rows:
+        return position_ids
+
+    stm = insert(MapPosition).values(list(rows.values()))
+    stm = stm.on_conflict_do_update(
+        constraint="unique_position",
+        # Существующее название не перезаписываем, DO UPDATE нужен, чтобы RETURNING вернул и старые строки
+        set_={"name": func.coalesce(MapPosition.name, stm.excluded.name)},
+    ).returning(MapPosition.id, MapPosition.map, MapPosition.position)
+
+    for map_position_id, map_name, position in (await session.execute(stm)).all():
+        key = map_position_key(map_name, position)
+        position_ids[key] = map_position_id
+        remember_position(session, key, map_position_id)
+        mark_map_changed(session, map_name)
+    return position_ids
+
+
+async def bulk_upsert_key_combos(texts: list[str], session: AsyncSession) -> dict[str, int]:
+    key_combo_ids = {}
+    rows = {}
+    for text in texts:
+        key_combo_id = await resolution_index.get_key_combo_id(text, session)
+        if key_combo_id:
+            key_combo_ids[key_combo_key(text)] = key_combo_id
+        else:
+            rows[key_combo_key(text)] = {"text": text}
+    if not rows:
+        return key_combo_ids
+
+    stm = insert(KeyCombo).values(list(rows.values()))
+    stm = stm.on_conflict_do_update(
+        index_elements=[KeyCombo.text],
+        set_={"text": KeyCombo.text},
+    ).returning(KeyCombo.id, KeyCombo.text)
+
+    for key_combo_id, text in (await session.execute(stm)).all():
+        key_combo_ids[key_combo_key(text)] = key_combo_id
+        remember_key_combo(session, key_combo_key(text), key_combo_id)
+    mark_key_combos_changed(session)
+    return key_combo_ids
+
+
+async def bulk_process_grenade_data(new_grenades: list[NewGrenade], session: AsyncSession) -> list[Grenade]:
+    grenade_ids = [new_grenade.id for new_grenade in new_grenades]
+    if len(set(grenade_ids)) != len(grenade_ids):
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="ID гранат в пачке повторяются",
+        )
+
+    stm = select(Grenade.id, Grenade.map).where(Grenade.id.in_(grenade_ids))
+    old_maps = {grenade_id: map_name for grenade_id, map_name in (await session.execute(stm)).all()}
+    missing_ids = set(grenade_ids) - old_maps.keys()
+    if missing_ids:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Grenades [ID: {sorted(missing_ids)}] not found",
+        )
+
+    new_positions = []
+    new_key_combo_texts = []
+    for new_grenade in new_grenades:
+        for new_map_position in (new_grenade.initial_position, new_grenade.final_position):
+            if not new_map_position.id:
+                new_map_position.map = new_grenade.map
+                check_new_map_position(new_map_position)
+                new_positions.append(new_map_position)
+
+        if not new_grenade.key_combo.id:
+            if not new_grenade.key_combo.text:
+                raise HTTPException(
+                    status_code=status.HTTP_304_NOT_MODIFIED,
+                    detail=f"Не хватает полей в key_combo гранаты [ID: {new_grenade.id}]",
+                )
+            new_key_combo_texts.append(new_grenade.key_combo.text)
+
+    try:
+        position_ids = await bulk_upsert_map_positions(new_positions, session)
+        key_combo_ids = await bulk_upsert_key_combos(new_key_combo_texts, session)
+
+        def resolve_position(new_map_position: NewMapPosition) -> int:
+            if new_map_position.id:
+                return new_map_position.id
+            return position_ids[map_position_key(new_map_position.map, new_map_position.position)]
+
+        grenades_dumped = []
+        for new_grenade in new_grenades:
+            grenade_dumped = new_grenade.model_dump(exclude={"initial_position", "final_position", "key_combo"})
+            grenade_dumped.update(
+                initial_position_id=resolve_position(new_grenade.initial_position),
+                final_position_id=resolve_position(new_grenade.final_position),
+                key_combo_id=new_grenade.key_combo.id or key_combo_ids[key_combo_key(new_grenade.key_combo.text)],
+            )
+            grenades_dumped.append(grenade_dumped)
+
+        # ORM bulk UPDATE по первичному ключу - один executemany на всю пачку
+        await session.execute(update(Grenade), grenades_dumped)
+    except IntegrityError as e:
+        await session.rollback()
+        logging.error(e.orig.__repr__())
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+        )
+
+    for new_grenade in new_grenades:
+        mark_map_changed(session, new_grenade.map)
+        if old_maps[new_grenade.id]:
+            mark_map_changed(session, old_maps[new_grenade.id])
+
+    stm = select(Grenade).where(Grenade.id.in_(grenade_ids)).execution_options(populate_existing=True)
+    return list((await session.execute(stm)).scalars().all())
+
+
+async def search_catalogue(
+    query: str, map_name: CsMaps | None, limit: int, session: AsyncSession
+) -> list[SearchResultPublic]:
+    # Выражения совпадают с триграммными индексами из db.models, иначе postgres их не использует
+    sources = [
+        (ItemType.MAP_POSITION, MapPosition.id, MapPosition.name, MapPosition.map, []),
+        (ItemType.KEY_COMBO, KeyCombo.id, cast(KeyCombo.text, Text), cast(null(), MapPosition.map.type), []),
+        (
+            ItemType.GRENADE,
+            Grenade.id,
+            Grenade.data.op("->>", return_type=Text)(literal_column("'additional_info'")),
+            Grenade.map,
+            [Grenade.tg_post_id.is_not(None)],
+        ),
+    ]
+
+    statements = []
+    for item_type, id_column, text_column, map_column, conditions in sources:
+        if map_name is not None and item_type != ItemType.KEY_COMBO:
+            conditions = [*conditions, map_column == map_name.value]
+        statements.append(
+            select(
+                literal(item_type.value).label("type"),
+                id_column.label("id"),
+                text_column.label("text"),
+                map_column.label("map"),
+                # word_similarity, а не similarity: запрос из набора ищется как часть более длинного названия
+                func.word_similarity(query, text_column).label("score"),
+            ).where(
+                and_(
+                    *conditions,
+                    or_(text_column.op("%>")(query), text_column.icontains(query, autoescape=True)),
+                )
+            )
+        )
+
+    stm = union_all(*statements).order_by(literal_column("score").desc()).limit(limit)
+    return [SearchResultPublic.model_validate(row._mapping) for row in (await session.execute(stm)).all()]
@@ -1,3 +1,21 @@
+from fastapi_cache import FastAPICache
+from db.models import CsMaps
+
+
 def custom_key_builder(func, namespace: str, request, response, *args, **kwargs):
     # Используем только filter_query для формирования ключа
     return f"{namespace}:{kwargs['kwargs']['map_name'].value}"
+
+
+def map_cache_key(namespace: str, map_name: CsMaps) -> str:
+    # Должен совпадать с ключом, который строит custom_key_builder
+    return f"{FastAPICache.get_prefix()}:{namespace}:{map_name.value}"
+
+
+def user_key_builder(func, namespace: str, request, response, *args, **kwargs):
+    return f"{namespace}:{kwargs['kwargs']['user_id']}"
+
+
+def user_cache_key(namespace: str, user_id: int) -> str:
+    # Должен совпадать с ключом, который строит user_key_builder
+    return f"{FastAPICache.get_prefix()}:{namespace}:{user_id}"
@@ -1,7 +1,16 @@
-from typing import TypedDict
+from dataclasses import dataclass, field
+from typing import TypedDict, Optional
 
 
 class CreateGrenadeJobResponse(TypedDict):
     tg_post_id: int
     setup_photo_msg_id: int
     finish_photo_msg_id: int
+
+
+@dataclass
+class CachedBody:
+    etag: str
+    body: bytes
+    msgpack_body: Optional[bytes] = None
+    compressed: dict[str, bytes] = field(default_factory=dict)  # "media_type:encoding" -> сжатое тело
@@ -0,0 +1,212 @@
+import asyncio
+import logging
+from datetime import timedelta
+from arq import ArqRedis
+from arq.jobs import Job
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm.attributes import flag_modified
+from sqlmodel import select, and_, or_, func
+from db.engine import AsyncSessionMaker
+from db.models import Grenade, GrenadePostJob, PostJobStatus
+from funcs.cache_funcs import commit_and_invalidate, mark_map_changed
+from funcs.objects import CreateGrenadeJobResponse
+
+
+logger = logging.getLogger("api_logger")
+
+OUTBOX_POLL_INTERVAL = 5  # секунд, между проверками outbox, если никто не разбудил диспетчер
+OUTBOX_BATCH_SIZE = 20
+JOB_RESULT_TIMEOUT = 300  # секунд
+# Задача в статусе ENQUEUED без результата дольше этого времени снова подхватывается диспетчером
+# (например, воркер, который ждал результат, был перезапущен)
+STALE_JOB_AFTER = timedelta(seconds=JOB_RESULT_TIMEOUT * 2)
+# Пока по гранате есть активная задача, новая не создаётся: правка до появления tg_post_id ушла бы без поста,
+# а две правки подряд выполнялись бы параллельно, и последней могла бы примениться старая
+POST_JOB_FUNCTIONS = ("create_grenade_post", "edit_grenade_post")
+
+_wakeup = asyncio.Event()
+_watchers: set[asyncio.Task] = set()
+
+
+def dump_grenade_for_post(grenade: Grenade) -> dict:
+    dumped_model = grenade.model_dump(
+        mode="json",
+        include={
+            "id",
+            "type",
+            "side",
+            "difficult",
+            "tg_post_id",
+            "data",
+            "tg_data",
+            "map",
+        },
+    )
+    dumped_model["initial_position"] = grenade.initial_position.model_dump(mode="json")
+    dumped_model["final_position"] = grenade.final_position.model_dump(mode="json")
+    dumped_model["key_combo"] = grenade.key_combo.model_dump(mode="json")
+    return dumped_model
+
+
+async def add_post_job(grenade: Grenade, function: str, session: AsyncSession) -> GrenadePostJob:
+    job = GrenadePostJob(grenade_id=grenade.id, function=function, payload=dump_grenade_for_post(grenade))
+    session.add(job)
+    await session.flush()
+    return job
+
+
+async def add_post_jobs(grenades: list[Grenade], session: AsyncSession) -> list[GrenadePostJob]:
+    # Уже опубликованные гранаты редактируются, новые - публикуются
+    jobs = [
+        GrenadePostJob(
+            grenade_id=grenade.id,
+            function="edit_grenade_post" if grenade.tg_post_id else "create_grenade_post",
+            payload=dump_grenade_for_post(grenade),
+        )
+        for grenade in grenades
+    ]
+    session.add_all(jobs)
+    await session.flush()
+    return jobs
+
+
+async def get_active_post_job_grenade_ids(
+    grenade_ids: list[int], session: AsyncSession, functions: tuple[str, ...] = POST_JOB_FUNCTIONS
+) -> set[int]:
+    # Строки гранат блокируются до конца транзакции: параллельная запись по той же гранате дождётся коммита
+    # и уже увидит созданную здесь задачу
+    await session.execute(select(Grenade.id).where(Grenade.id.in_(grenade_ids)).order_by(Grenade.id).with_for_update())
+    stm = select(GrenadePostJob.grenade_id).where(
+        and_(
+            GrenadePostJob.grenade_id.in_(grenade_ids),
+            GrenadePostJob.function.in_(functions),
+            GrenadePostJob.status.in_([PostJobStatus.PENDING, PostJobStatus.ENQUEUED]),
+        )
+    )
+    return set((await session.execute(stm)).scalars().all())
+
+
+async def has_active_post_job(
+    grenade_id: int, session: AsyncSession, functions: tuple[str, ...] = POST_JOB_FUNCTIONS
+) -> bool:
+    return bool(await get_active_post_job_grenade_ids([grenade_id], session, functions))
+
+
+# Вызывается после коммита, чтобы диспетчер отправил задачу сразу, а не по таймеру
+def notify_outbox() -> None:
+    _wakeup.set()
+
+
+async def run_outbox_dispatcher(queue: ArqRedis) -> None:
+    while True:
+        try:
+            dispatched = await dispatch_post_jobs(queue)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Outbox dispatcher error: {e!r}")
+            dispatched = 0
+
+        if dispatched < OUTBOX_BATCH_SIZE:
+            try:
+                await asyncio.wait_for(_wakeup.wait(), timeout=OUTBOX_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            _wakeup.clear()
+
+
+async def stop_outbox_dispatcher(dispatcher: asyncio.Task) -> None:
+    for task in (dispatcher, *_watchers):
+        task.cancel()
+    await asyncio.gather(dispatcher, *_watchers, return_exceptions=True)
+
+
+async def dispatch_post_jobs(queue: ArqRedis) -> int:
+    # Транзакция держит блокировку только на строках outbox и только на время записи в redis
+    async with AsyncSessionMaker() as session:
+        stm = (
+            select(GrenadePostJob)
+            .where(
+                or_(
+                    GrenadePostJob.status == PostJobStatus.PENDING,
+                    and_(
+                        GrenadePostJob.status == PostJobStatus.ENQUEUED,
+                        GrenadePostJob.update_date < func.localtimestamp() - STALE_JOB_AFTER,
+                    ),
+                )
+            )
+            .order_by(GrenadePostJob.id)
+            .limit(OUTBOX_BATCH_SIZE)
+            .with_for_update(skip_locked=True)
+        )
+        post_jobs = (await session.execute(stm)).scalars().all()
+
+        arq_jobs = []
+        for post_job in post_jobs:
+            job_id = f"outbox_{post_job.id}"
+            # Если задача с таким ID уже есть в arq (повторная отправка), enqueue_job вернёт None
+            arq_job = await queue.enqueue_job(post_job.function, post_job.payload, _job_id=job_id) or Job(
+                job_id,
+                redis=queue,
+                _queue_name=queue.default_queue_name,
+                _deserializer=queue.job_deserializer,
+            )
+            arq_jobs.append((post_job.id, arq_job))
+
+            # flag_modified нужен и для уже ENQUEUED задач: UPDATE обновит update_date (onupdate),
+            # и задачу не подхватит другой воркер до STALE_JOB_AFTER
+            post_job.status = PostJobStatus.ENQUEUED
+            flag_modified(post_job, "status")
+            session.add(post_job)
+        await session.commit()
+
+    for post_job_id, arq_job in arq_jobs:
+        logger.info(f"Post job [outbox_{post_job_id}] sent to worker")
+        task = asyncio.create_task(watch_post_job(post_job_id, arq_job))
+        _watchers.add(task)
+        task.add_done_callback(_watchers.discard)
+
+    return len(post_jobs)
+
+
+async def watch_post_job(post_job_id: int, arq_job: Job) -> None:
+    try:
+        result = await arq_job.result(timeout=JOB_RESULT_TIMEOUT)
+    except asyncio.TimeoutError:
+        # Статус остаётся ENQUEUED, задачу подхватит диспетчер после STALE_JOB_AFTER
+        logger.warning(f"Post job [outbox_{post_job_id}] result timeout")
+        return
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.error(f"Post job [outbox_{post_job_id}] failed: {e!r}")
+        await finish_post_job(post_job_id, None, error=repr(e))
+        return
+
+    await finish_post_job(post_job_id, result)
+
+
+async def finish_post_job(post_job_id: int, result: CreateGrenadeJobResponse | None, error: str | None = None) -> None:
+    async with AsyncSessionMaker() as session:
+        post_job = await session.get(GrenadePostJob, post_job_id, with_for_update=True)
+        if post_job is None or post_job.status != PostJobStatus.ENQUEUED:
+            return
+
+        if error:
+            post_job.status = PostJobStatus.FAILED
+            post_job.error = error
+        else:
+            if post_job.function == "create_grenade_post":
+                grenade = await session.get(Grenade, post_job.grenade_id)
+                grenade.tg_post_id = result["tg_post_id"]
+                grenade.tg_data.setup_photo_msg_id = result["setup_photo_msg_id"]
+                grenade.tg_data.finish_photo_msg_id = result["finish_photo_msg_id"]
+                flag_modified(grenade, "tg_data")
+                session.add(grenade)
+                # После появления tg_post_id граната становится видна в выдаче карты
+                mark_map_changed(session, grenade.map)
+            post_job.status = PostJobStatus.DONE
+            logger.info(f"Post job [outbox_{post_job_id}] completed")
+
+        session.add(post_job)
+        await commit_and_invalidate(session)
@@ -0,0 +1,112 @@
+import asyncio
+from typing import Optional
+from fastapi_cache import FastAPICache
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlmodel import select
+from db.models import MapPosition, KeyCombo, CsMaps, Position
+
+
+RESOLUTION_INDEX_NAMESPACE = "resolution_index"
+
+
+def map_position_key(map_name: CsMaps | str, position: Position) -> tuple:
+    return CsMaps(map_name).value, position.top, position.right, position.bottom, position.left
+
+
+def key_combo_key(text: str) -> str:
+    # KeyCombo.text - CITEXT, поэтому сравнение без учёта регистра
+    return text.lower()
+
+
+class ResolutionIndex:
+    """
+    Индекс в памяти воркера: (map, position) -> MapPosition.id и text -> KeyCombo.id.
+    Новые записи добавляются после коммита, при изменении/удалении позиций или комбо индекс сбрасывается
+    на всех воркерах и лениво загружается заново
+    """
+
+    def __init__(self):
+        self._positions: dict[tuple, int] = {}
+        self._key_combos: dict[str, int] = {}
+        self._loaded = False
+        self._generation = 0
+        self._lock = asyncio.Lock()
+
+    async def _ensure_loaded(self, session: AsyncSession) -> None:
+        if self._loaded:
+            return
+
+        async with self._lock:
+            if self._loaded:
+                return
+
+            generation = self._generation
+            stm = select(MapPosition.id, MapPosition.map, MapPosition.position)
+            positions = {
+                map_position_key(map_name, position): map_position_id
+                for map_position_id, map_name, position in (await session.execute(stm)).all()
+                if position
+            }
+            stm = select(KeyCombo.id, KeyCombo.text)
+            key_combos = {key_combo_key(text): key_combo_id for key_combo_id, text in (await session.execute(stm)).all()}
+
+            # Если индекс сбросили во время загрузки, загруженные данные могли устареть
+            if generation == self._generation:
+                self._positions.update(positions)
+                self._key_combos.update(key_combos)
+                self._loaded = True
+
+    async def get_position_id(self, map_name: CsMaps | str, position: Position, session: AsyncSession) -> Optional[int]:
+        await self._ensure_loaded(session)
+        return self._positions.get(map_position_key(map_name, position))
+
+    async def get_key_combo_id(self, text: str, session: AsyncSession) -> Optional[int]:
+        await self._ensure_loaded(session)
+        return self._key_combos.get(key_combo_key(text))
+
+    def update(self, positions: dict[tuple, int], key_combos: dict[str, int]) -> None:
+        self._positions.update(positions)
+        self._key_combos.update(key_combos)
+
+    def reset(self) -> None:
+        self._generation += 1
+        self._positions.clear()
+        self._key_combos.clear()
+        self._loaded = False
+
+    def on_cache_clear(self, namespace: Optional[str], key: Optional[str]) -> None:
+        if (namespace is None and key is None) or (namespace and namespace.endswith(RESOLUTION_INDEX_NAMESPACE)):
+            self.reset()
+
+
+resolution_index = ResolutionIndex()
+
+
+# Изменения копятся в сессии и попадают в индекс только после коммита, чтобы откаченные ID не остались в индексе
+def remember_position(session: AsyncSession, key: tuple, map_position_id: int) -> None:
+    session.info.setdefault("resolved_positions", {})[key] = map_position_id
+
+
+def remember_key_combo(session: AsyncSession, key: str, key_combo_id: int) -> None:
+    session.info.setdefault("resolved_key_combos", {})[key] = key_combo_id
+
+
+def mark_resolution_index_stale(session: AsyncSession) -> None:
+    session.info["resolution_index_stale"] = True
+
+
+def pop_resolution_changes(session: AsyncSession) -> tuple[dict[tuple, int], dict[str, int], bool]:
+    return (
+        session.info.pop("resolved_positions", {}),
+        session.info.pop("resolved_key_combos", {}),
+        session.info.pop("resolution_index_stale", False),
+    )
+
+
+async def apply_resolution_changes(changes: tuple[dict[tuple, int], dict[str, int], bool]) -> None:
+    positions, key_combos, is_stale = changes
+    if is_stale:
+        # Сброс рассылается всем воркерам через pub/sub бэкенда кэша (см. on_cache_clear), ключей в кэше у индекса нет
+        await FastAPICache.get_backend().signal(RESOLUTION_INDEX_NAMESPACE)
+    else:
+        resolution_index.update(positions, key_combos)
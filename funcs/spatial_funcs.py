@@ -0,0 +1,159 @@
+import heapq
+import math
+from dataclasses import dataclass
+from typing import Optional, Type, TypeVar
+import orjson
+from sqlalchemy.ext.asyncio import AsyncSession
+from db.models import CsMaps
+from funcs.cache_funcs import get_map_grenades
+
+
+# На нулевом зуме карта делится на CLUSTER_GRID_BASE x CLUSTER_GRID_BASE ячеек, каждый следующий зум делит ячейку на 4
+CLUSTER_GRID_BASE = 4
+CLUSTER_MAX_ZOOM = 6
+POSITION_INDEX_CELL_SIZE = 5  # в процентах карты
+NEAREST_MAX_K = 20
+
+
+@dataclass
+class GridCluster:
+    top: float
+    left: float
+    count: int
+    grenade_ids: list[int]
+
+
+@dataclass
+class BoundingBox:
+    min_top: float = 0
+    max_top: float = 100
+    min_left: float = 0
+    max_left: float = 100
+
+    def contains(self, top: float, left: float) -> bool:
+        return self.min_top <= top <= self.max_top and self.min_left <= left <= self.max_left
+
+
+class MapGrid:
+    """Кластеры гранат карты по final_position для каждого зума, считаются один раз на версию кэша карты"""
+
+    def __init__(self, grenades: list[dict]):
+        points = []
+        for grenade in grenades:
+            position = grenade["final_position"]["position"]
+            if position and position["top"] is not None:
+                points.append((position["top"], position["left"], grenade["id"]))
+
+        self.levels = [self._build_level(points, zoom) for zoom in range(CLUSTER_MAX_ZOOM + 1)]
+
+    @staticmethod
+    def _build_level(points: list[tuple[float, float, int]], zoom: int) -> list[GridCluster]:
+        cell_size = 100 / (CLUSTER_GRID_BASE * 2 ** zoom)
+        cells: dict[tuple[int, int], list[tuple[float, float, int]]] = {}
+        for top, left, grenade_id in points:
+            cells.setdefault((int(top // cell_size), int(left // cell_size)), []).append((top, left, grenade_id))
+
+        # Маркер кластера ставится в центр масс его гранат, а не в центр ячейки
+        return [
+            GridCluster(
+                top=round(sum(point[0] for point in cell) / len(cell), 2),
+                left=round(sum(point[1] for point in cell) / len(cell), 2),
+                count=len(cell),
+                grenade_ids=sorted(point[2] for point in cell),
+            )
+            for cell in cells.values()
+        ]
+
+    def get_clusters(self, zoom: int, bbox: Optional[BoundingBox] = None) -> list[GridCluster]:
+        clusters = self.levels[min(zoom, CLUSTER_MAX_ZOOM)]
+        if bbox is None:
+            return clusters
+        return [cluster for cluster in clusters if bbox.contains(cluster.top, cluster.left)]
+
+
+@dataclass
+class IndexedPosition:
+    id: int
+    top: float
+    left: float
+    position: dict
+    grenades: list[dict]
+
+
+class PositionIndex:
+    """Равномерная сетка позиций карты (final_position) для поиска ближайших к точке, с гранатами каждой позиции"""
+
+    position_field = "final_position"
+
+    def __init__(self, grenades: list[dict]):
+        positions: dict[int, IndexedPosition] = {}
+        for grenade in grenades:
+            map_position = grenade[self.position_field]
+            position = map_position["position"]
+            if not position or position["top"] is None:
+                continue
+            if map_position["id"] not in positions:
+                positions[map_position["id"]] = IndexedPosition(
+                    id=map_position["id"],
+                    top=position["top"],
+                    left=position["left"],
+                    position=map_position,
+                    grenades=[],
+                )
+            positions[map_position["id"]].grenades.append(grenade)
+
+        self.size = len(positions)
+        self.cells: dict[tuple[int, int], list[IndexedPosition]] = {}
+        for indexed_position in positions.values():
+            self.cells.setdefault(self._cell(indexed_position.top, indexed_position.left), []).append(indexed_position)
+
+    @staticmethod
+    def _cell(top: float, left: float) -> tuple[int, int]:
+        return int(top // POSITION_INDEX_CELL_SIZE), int(left // POSITION_INDEX_CELL_SIZE)
+
+    def nearest(self, top: float, left: float, k: int) -> list[tuple[float, IndexedPosition]]:
+        k = min(k, self.size)
+        if not k:
+            return []
+
+        center_row, center_col = self._cell(top, left)
+        max_ring = math.ceil(100 / POSITION_INDEX_CELL_SIZE)
+        found: list[tuple[float, IndexedPosition]] = []
+        # Кольца ячеек вокруг точки, пока k-я найденная позиция не окажется ближе, чем следующее кольцо
+        for ring in range(max_ring + 1):
+            for row in range(center_row - ring, center_row + ring + 1):
+                for col in range(center_col - ring, center_col + ring + 1):
+                    if max(abs(row - center_row), abs(col - center_col)) != ring:
+                        continue
+                    for indexed_position in self.cells.get((row, col), []):
+                        distance = math.hypot(indexed_position.top - top, indexed_position.left - left)
+                        found.append((distance, indexed_position))
+
+            if len(found) < k:
+                continue
+            nearest = heapq.nsmallest(k, found, key=lambda item: item[0])
+            # Все ещё не просмотренные позиции дальше ring * POSITION_INDEX_CELL_SIZE от точки
+            if nearest[-1][0] <= ring * POSITION_INDEX_CELL_SIZE:
+                return nearest
+
+        return heapq.nsmallest(k, found, key=lambda item: item[0])
+
+
+class InitialPositionIndex(PositionIndex):
+    position_field = "initial_position"
+
+
+MapIndex = TypeVar("MapIndex", MapGrid, PositionIndex)
+
+# (map, класс индекса) -> (etag тела из кэша, индекс). Сбросом занимается кэш карты: после инвалидации у тела
+# новый etag, и индекс перестраивается только для изменившейся карты
+_map_indexes: dict[tuple[CsMaps, type], tuple[str, object]] = {}
+
+
+async def get_map_index(map_name: CsMaps, index_class: Type[MapIndex], session: AsyncSession) -> MapIndex:
+    cached = await get_map_grenades(map_name=map_name, session=session)
+    item = _map_indexes.get((map_name, index_class))
+    if item is None or item[0] != cached.etag:
+        item = (cached.etag, index_class(orjson.loads(cached.body)))
+        _map_indexes[(map_name, index_class)] = item
+    return item[1]
@@ -1,51 +1,94 @@
+import asyncio
 import hashlib
 import hmac
 import json
-from copy import deepcopy
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from datetime import timedelta, datetime, timezone
 from operator import itemgetter
-from typing import Optional, Any
+from typing import Optional, Any, Hashable
 from urllib.parse import parse_qsl
 from fastapi import HTTPException, Depends
 from fastapi.security import OAuth2PasswordBearer
 from jose import jwt, JWTError
 from passlib.context import CryptContext
-from sqlalchemy.dialects.postgresql import insert
-from sqlalchemy.exc import IntegrityError
-from sqlmodel import col
-from sqlmodel.ext.asyncio.session import AsyncSession
 from starlette import status
 from config import CONFIG
-from db.models import NewUser, User
 
 
 ADMIN_CONFIG = CONFIG.admin_data
 ALGORITHM = "HS256"
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+VERIFIED_TOKENS_MAXSIZE = 10000
+# bcrypt держит CPU десятки мс, поэтому проверки идут в отдельных потоках, не больше PASSWORD_WORKERS одновременно
+PASSWORD_WORKERS = 2
+password_executor = ThreadPoolExecutor(max_workers=PASSWORD_WORKERS, thread_name_prefix="password")
+# Проверок в работе и в очереди executor'а одновременно. Остальные сразу получают 429, а не копятся в очереди
+PASSWORD_CHECKS_LIMIT = 8
+# Освобождается из потока executor'а, когда bcrypt действительно закончил, поэтому threading, а не asyncio
+password_checks = threading.BoundedSemaphore(PASSWORD_CHECKS_LIMIT)
+LOGIN_MAX_FAILURES = 5
+LOGIN_FAILURE_WINDOW = 300  # секунд
+LOGIN_THROTTLE_MAXSIZE = 10000
+WEBAPP_AUTH_MAX_AGE = 86400  # секунд, более старые initData не принимаются
+WEBAPP_AUTH_CLOCK_SKEW = 60  # секунд, на которые auth_date может опережать часы сервера
+# Повторная отправка того же initData в течение WEBAPP_RECENT_TTL не проверяется и не пишется в БД заново
+WEBAPP_RECENT_TTL = 300  # секунд
+WEBAPP_RECENT_MAXSIZE = 10000
 
 
-async def add_or_update_user(new_user: NewUser, session: AsyncSession) -> bool:
-    user_dumped = new_user.model_dump()
-    data_for_update = deepcopy(user_dumped)
-    del data_for_update["chat_data"]
-    del data_for_update["invite_url"]
+class TTLCache:
+    """LRU-кэш в памяти воркера, у каждой записи свой срок жизни (unix time)"""
 
-    try:
-        stm = (
-            insert(User)
-            .values(**user_dumped)
-            .on_conflict_do_update(index_elements=[col(User.id)], set_=data_for_update)
-            .returning(User.is_subscribed)
-        )
-        is_subscribed = (await session.execute(stm)).scalar()
-        return is_subscribed
-    except IntegrityError as e:
-        await session.rollback()
-        raise HTTPException(
-            status_code=status.HTTP_409_CONFLICT,
-            detail=e.orig.__repr__().split(": ", 1)[1].strip(".')"),
-        )
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._store: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        item = self._store.get(key)
+        if item is None:
+            return None
+
+        expire_ts, value = item
+        if expire_ts <= time.time():
+            del self._store[key]
+            return None
+
+        self._store.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any, expire_ts: float) -> None:
+        self._store[key] = (expire_ts, value)
+        self._store.move_to_end(key)
+        while len(self._store) > self.maxsize:
+            self._store.popitem(last=False)
+
+
+# Payload успешно проверенных JWT до их exp
+verified_tokens = TTLCache(VERIFIED_TOKENS_MAXSIZE)
+
+
+def decode_token(token: str, key: str) -> dict:
+    # Ключ зависит от секрета, поэтому после смены секрета старые токены снова проходят полную проверку
+    cache_key = hashlib.blake2b(f"{key}\n{token}".encode(), digest_size=32).digest()
+    payload = verified_tokens.get(cache_key)
+    if payload is None:
+        # В кэш попадают только токены, прошедшие jwt.decode: с верной подписью и не истёкшие.
+        # Токены без exp не кэшируются, иначе они жили бы в кэше бессрочно
+        payload = jwt.decode(token, key, algorithms=ALGORITHM)
+        if isinstance(payload.get("exp"), (int, float)):
+            verified_tokens.set(cache_key, payload, payload["exp"])
+    return payload
+
+
+# Секрет зависит только от токена бота, поэтому считается один раз
+@lru_cache(maxsize=4)
+def get_webapp_secret_key(token: str) -> bytes:
+    return hmac.new(key=b"WebAppData", msg=token.encode(), digestmod=hashlib.sha256).digest()
 
 
 def check_webapp_signature(token: str, data: str) -> bool:
@@ -60,18 +103,48 @@ def check_webapp_signature(token: str, data: str) -> bool:
     data_check_string = "\n".join(
         f"{k}={v}" for k, v in sorted(parsed_data.items(), key=itemgetter(0))
     )
-    secret_key = hmac.new(
-        key=b"WebAppData", msg=token.encode(), digestmod=hashlib.sha256
-    )
     calculated_hash = (
         hmac.new(
-            key=secret_key.digest(),
+            key=get_webapp_secret_key(token),
             msg=data_check_string.encode(),
             digestmod=hashlib.sha256,
         )
         .hexdigest()
     )
-    return calculated_hash == hash_
+    # hash_ приходит от клиента и может быть не ASCII, а compare_digest для таких str бросает TypeError
+    if not hmac.compare_digest(calculated_hash.encode(), hash_.encode()):
+        return False
+
+    auth_date = get_auth_date(parsed_data)
+    if auth_date is None:
+        return False
+    age = time.time() - auth_date
+    return -WEBAPP_AUTH_CLOCK_SKEW <= age <= WEBAPP_AUTH_MAX_AGE
+
+
+def get_auth_date(parsed_data: dict[str, str]) -> Optional[int]:
+    try:
+        return int(parsed_data["auth_date"])
+    except (KeyError, ValueError):
+        return None
+
+
+# is_subscribed для недавно проверенных initData. Ключ - хэш всего initData, а не только поля hash,
+# чтобы initData с подменёнными полями не прошёл мимо проверки подписи
+recent_webapp_data = TTLCache(WEBAPP_RECENT_MAXSIZE)
+
+
+def get_recent_is_subscribed(data: str) -> Optional[bool]:
+    return recent_webapp_data.get(hashlib.blake2b(data.encode(), digest_size=32).digest())
+
+
+def remember_webapp_data(data: str, is_subscribed: bool) -> None:
+    auth_date = get_auth_date(dict(parse_qsl(data)))
+    if auth_date is None:
+        return
+
+    expire_ts = min(time.time() + WEBAPP_RECENT_TTL, auth_date + WEBAPP_AUTH_MAX_AGE)
+    recent_webapp_data.set(hashlib.blake2b(data.encode(), digest_size=32).digest(), is_subscribed, expire_ts)
 
 
 def parse_webapp_init_data(data: str) -> dict[str, Any]:
@@ -88,6 +161,78 @@ def verify_password(plain_password, hashed_password) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
 
+async def verify_password_async(plain_password, hashed_password) -> bool:
+    if not password_checks.acquire(blocking=False):
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many login attempts in progress",
+            headers={"Retry-After": "1"},
+        )
+
+    future = password_executor.submit(verify_password, plain_password, hashed_password)
+    future.add_done_callback(lambda _: password_checks.release())
+    return await asyncio.wrap_future(future)
+
+
+class LoginThrottle:
+    """
+    Неудачные попытки входа по клиентам. После LOGIN_MAX_FAILURES неудач за LOGIN_FAILURE_WINDOW секунд
+    клиент получает 429 до конца окна, пароль при этом не проверяется. Незавершённые попытки считаются
+    неудачами заранее, иначе параллельная пачка запросов целиком прошла бы проверку до первой неудачи
+    """
+
+    def __init__(self, max_failures: int, window: int, maxsize: int):
+        self.max_failures = max_failures
+        self.window = window
+        self.maxsize = maxsize
+        self._failures: OrderedDict[str, tuple[float, int]] = OrderedDict()
+        self._in_flight: dict[str, int] = {}
+
+    def _get_failures(self, client: str) -> tuple[float, int]:
+        item = self._failures.get(client)
+        if item is None:
+            return 0.0, 0
+
+        window_end, failures = item
+        if window_end <= time.monotonic():
+            del self._failures[client]
+            return 0.0, 0
+        return item
+
+    def acquire(self, client: str) -> int:
+        """Занимает попытку для клиента. Возвращает 0 или через сколько секунд повторить (попытка не занята)"""
+        window_end, failures = self._get_failures(client)
+        if failures >= self.max_failures:
+            return int(window_end - time.monotonic()) + 1
+
+        in_flight = self._in_flight.get(client, 0)
+        if failures + in_flight >= self.max_failures:
+            # Ждём результата уже идущих попыток
+            return 1
+        self._in_flight[client] = in_flight + 1
+        return 0
+
+    def release(self, client: str) -> None:
+        in_flight = self._in_flight.pop(client, 0) - 1
+        if in_flight > 0:
+            self._in_flight[client] = in_flight
+
+    def add_failure(self, client: str) -> None:
+        now = time.monotonic()
+        window_end, failures = self._failures.pop(client, (now + self.window, 0))
+        if window_end <= now:
+            window_end, failures = now + self.window, 0
+        self._failures[client] = (window_end, failures + 1)
+        while len(self._failures) > self.maxsize:
+            self._failures.popitem(last=False)
+
+    def reset(self, client: str) -> None:
+        self._failures.pop(client, None)
+
+
+login_throttle = LoginThrottle(LOGIN_MAX_FAILURES, LOGIN_FAILURE_WINDOW, LOGIN_THROTTLE_MAXSIZE)
+
+
 # Создание JWT-токена
 def create_access_token(data: dict, key: str, expires_delta: Optional[timedelta] = None) -> str:
     to_encode = data.copy()
@@ -108,7 +253,7 @@ async def get_current_admin(token: str = Depends(oauth2_scheme)) -> str:
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(token, ADMIN_CONFIG.secret_key, algorithms=ALGORITHM)
+        payload = decode_token(token, ADMIN_CONFIG.secret_key)
         username: str = payload.get("keyword")
         if username != ADMIN_CONFIG.username:
             raise credentials_exception
@@ -124,7 +269,7 @@ async def validate_token(token: str = Depends(oauth2_scheme)) -> str:
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(token, CONFIG.bot_token, algorithms=ALGORITHM)
+        payload = decode_token(token, CONFIG.bot_token)
         if payload.get("keyword") != "regular":
             raise credentials_exception
     except JWTError:
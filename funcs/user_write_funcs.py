@@ -0,0 +1,115 @@
+import asyncio
+import hashlib
+import logging
+import time
+import orjson
+from fastapi import HTTPException
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlmodel import select
+from starlette import status
+from db.engine import AsyncSessionMaker
+from db.models import NewUser, User
+from funcs.user_funcs import TTLCache
+
+
+logger = logging.getLogger("api_logger")
+
+USER_FLUSH_INTERVAL = 0.2  # секунд, за это время копится пачка изменений
+USER_FLUSH_BATCH_SIZE = 500
+USER_FINGERPRINT_TTL = 86400  # секунд
+USER_FINGERPRINTS_MAXSIZE = 100000
+# Поля, которые перезаписываются при повторном открытии мини-аппа. chat_data и invite_url пишутся только при создании
+USER_UPDATE_FIELDS = ("username", "user_data")
+
+# user_id -> отпечаток последних записанных в БД полей
+written_users = TTLCache(USER_FINGERPRINTS_MAXSIZE)
+
+_pending: dict[int, tuple[dict, list[asyncio.Future]]] = {}
+_wakeup = asyncio.Event()
+
+
+def user_fingerprint(user_dumped: dict) -> bytes:
+    fields = {field: user_dumped[field] for field in USER_UPDATE_FIELDS}
+    return hashlib.blake2b(orjson.dumps(fields, option=orjson.OPT_SORT_KEYS), digest_size=16).digest()
+
+
+async def save_user(new_user: NewUser, session: AsyncSession) -> bool:
+    """
+    Сохраняет юзера и возвращает is_subscribed. Если поля не изменились с последней записи - только читает
+    is_subscribed, иначе ставит upsert в пачку и ждёт, пока фоновый flusher её запишет
+    """
+    user_dumped = new_user.model_dump()
+    if written_users.get(new_user.id) == user_fingerprint(user_dumped):
+        is_subscribed = (await session.execute(select(User.is_subscribed).where(User.id == new_user.id))).scalar()
+        if is_subscribed is not None:
+            return is_subscribed
+
+    future = asyncio.get_running_loop().create_future()
+    _, futures = _pending.get(new_user.id, (None, []))
+    # Если юзер уже ждёт записи, пишется последняя версия его данных
+    _pending[new_user.id] = (user_dumped, [*futures, future])
+    _wakeup.set()
+    return await future
+
+
+async def upsert_users(users_dumped: list[dict], session: AsyncSession) -> dict[int, bool]:
+    stm = insert(User).values(users_dumped)
+    stm = stm.on_conflict_do_update(
+        index_elements=[User.id],
+        set_={field: stm.excluded[field] for field in USER_UPDATE_FIELDS},
+    ).returning(User.id, User.is_subscribed)
+    return {user_id: is_subscribed for user_id, is_subscribed in (await session.execute(stm)).all()}
+
+
+async def flush_users() -> None:
+    while _pending:
+        batch = {}
+        for user_id in list(_pending)[:USER_FLUSH_BATCH_SIZE]:
+            batch[user_id] = _pending.pop(user_id)
+
+        try:
+            async with AsyncSessionMaker() as session:
+                subscriptions = await upsert_users([user_dumped for user_dumped, _ in batch.values()], session)
+                await session.commit()
+        except asyncio.CancelledError:
+            # Пачка допишется в stop_user_flusher
+            _pending.update(batch)
+            raise
+        except Exception as e:
+            logger.error(f"Users flush error: {e!r}")
+            error = e
+            if isinstance(e, IntegrityError):
+                error = HTTPException(
+                    status_code=status.HTTP_409_CONFLICT,
+                    detail=e.orig.__repr__().split(": ", 1)[1].strip(".')"),
+                )
+            for _, futures in batch.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(error)
+            continue
+
+        expire_ts = time.time() + USER_FINGERPRINT_TTL
+        for user_id, (user_dumped, futures) in batch.items():
+            written_users.set(user_id, user_fingerprint(user_dumped), expire_ts)
+            for future in futures:
+                if not future.done():
+                    future.set_result(subscriptions[user_id])
+
+
+async def run_user_flusher() -> None:
+    while True:
+        await _wakeup.wait()
+        if len(_pending) < USER_FLUSH_BATCH_SIZE:
+            await asyncio.sleep(USER_FLUSH_INTERVAL)
+        _wakeup.clear()
+        await flush_users()
+
+
+async def stop_user_flusher(flusher: asyncio.Task) -> None:
+    flusher.cancel()
+    await asyncio.gather(flusher, return_exceptions=True)
+    # Изменения, которые не успели записать до остановки
+    await flush_users()
@@ -1,6 +1,8 @@
 import msgpack
 from arq import create_pool
 from arq.connections import RedisSettings
+from redis.asyncio import Redis
+from config import CONFIG
 
 
 async def create_redis_pool():
@@ -10,3 +12,11 @@ async def create_redis_pool():
         job_serializer=msgpack.packb,
         job_deserializer=lambda b: msgpack.unpackb(b, raw=False),
     )
+
+
+def create_cache_redis() -> Redis:
+    return Redis(
+        host="127.0.0.1",
+        port=CONFIG.redis_db.port,
+        db=CONFIG.redis_db.cache_db_index,
+    )
@@ -4,20 +4,21 @@ from typing import Annotated
 from fastapi import APIRouter, Query, Depends, HTTPException
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi_cache.decorator import cache
-from sqlmodel import select
 from starlette import status
+from starlette.requests import Request
 from config import CONFIG
 from db.models import (
     AdminDataResponse,
     CsMaps,
-    MapPosition,
-    KeyCombo,
     EnumTypesPublic,
     GrenadeType,
     GrenadeSide,
+    PoolStatsPublic,
 )
-from dependencies import SessionDep
-from funcs.user_funcs import verify_password, create_access_token, get_current_admin
+from db.engine import AsyncSessionMaker, get_pool_stats
+from dependencies import ReadSessionDep
+from funcs.cache_funcs import get_admin_data, make_cached_response
+from funcs.user_funcs import verify_password_async, create_access_token, get_current_admin, login_throttle
 
 
 logger = logging.getLogger("api_logger")
@@ -30,15 +31,31 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 360
 
 # Эндпоинт для получения токена
 @admin_router.post("/get_token")
-async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
-    if form_data.username != ADMIN_CONFIG.username or not verify_password(
-        form_data.password, ADMIN_CONFIG.password_hash
-    ):
+async def login_for_access_token(request: Request, form_data: OAuth2PasswordRequestForm = Depends()):
+    client = request.client.host if request.client else "unknown"
+    retry_after = login_throttle.acquire(client)
+    if retry_after:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many failed login attempts",
+            headers={"Retry-After": str(retry_after)},
+        )
+
+    try:
+        authenticated = form_data.username == ADMIN_CONFIG.username and await verify_password_async(
+            form_data.password, ADMIN_CONFIG.password_hash
+        )
+    finally:
+        login_throttle.release(client)
+
+    if not authenticated:
+        login_throttle.add_failure(client)
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    login_throttle.reset(client)
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
         {"keyword": ADMIN_CONFIG.username},
@@ -56,18 +73,12 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
 )
 async def return_admin_data(
     map_name: Annotated[CsMaps, Query()],
-    session: SessionDep,
+    request: Request,
+    session: ReadSessionDep,
     current_admin: str = Depends(get_current_admin),
 ):
-    stm = (
-        select(MapPosition)
-        .where(MapPosition.map == map_name.value)
-    )
-    map_positions = (await session.execute(stm)).scalars().all()
-
-    key_combos = (await session.execute(select(KeyCombo))).scalars().all()
-
-    return AdminDataResponse(map_positions=map_positions, key_combos=key_combos)
+    cached = await get_admin_data(map_name=map_name, session=session)
+    return make_cached_response(request, cached)
 
 
 @admin_router.get(
@@ -83,3 +94,13 @@ async def return_enum_values(current_admin: str = Depends(get_current_admin)):
         grenade_sides=[item.value for item in GrenadeSide],
         maps=[item.value for item in CsMaps],
     )
+
+
+@admin_router.get(
+    path="/pool_stats",
+    response_model=PoolStatsPublic,
+    status_code=status.HTTP_200_OK,
+    description="Возвращает статистику пула соединений с БД текущего воркера",
+)
+async def return_pool_stats(current_admin: str = Depends(get_current_admin)):
+    return get_pool_stats(AsyncSessionMaker.kw["bind"])
@@ -1,63 +1,121 @@
 import logging
+from datetime import datetime, timedelta
 from typing import Annotated
-from arq.jobs import SerializationError
 from fastapi import APIRouter, Query, HTTPException, Body, Depends
-from fastapi_cache.coder import PickleCoder
-from fastapi_cache.decorator import cache
+from sqlalchemy import BigInteger, DateTime, cast
 from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm.attributes import flag_modified
-from sqlmodel import select, and_, delete
+from sqlmodel import select, and_, delete, func, literal
 from starlette import status
-from db.models import GrenadePublic, Grenade, NewGrenade, CsMaps, UserFavourite
-from dependencies import SessionDep, QueueDep
-from funcs.grenade_funcs import process_grenade_data
-from funcs.key_builder import custom_key_builder
-from funcs.objects import CreateGrenadeJobResponse
+from starlette.requests import Request
+from db.models import (
+    GrenadePublic,
+    Grenade,
+    NewGrenade,
+    CsMaps,
+    GrenadeType,
+    GrenadeSide,
+    UserFavourite,
+    GrenadeTombstone,
+    GrenadeChangesPublic,
+    FavouriteAction,
+    FavouriteBatch,
+    FavouriteOperationResult,
+    GrenadePostJob,
+    GrenadePostJobPublic,
+    GrenadeClusterPublic,
+    NearestPositionPublic,
+    PositionKind,
+    SearchResultPublic,
+)
+from dependencies import SessionDep, ReadSessionDep
+from funcs.cache_funcs import (
+    get_map_grenades,
+    get_map_grouped_grenades,
+    get_favourite_ids,
+    make_cached_response,
+    commit_and_invalidate,
+    invalidate_user_favourites,
+)
+from funcs.grenade_funcs import process_grenade_data, bulk_process_grenade_data, search_catalogue
+from funcs.outbox_funcs import (
+    add_post_job,
+    add_post_jobs,
+    has_active_post_job,
+    get_active_post_job_grenade_ids,
+    notify_outbox,
+)
+from funcs.spatial_funcs import (
+    get_map_index,
+    MapGrid,
+    PositionIndex,
+    InitialPositionIndex,
+    BoundingBox,
+    CLUSTER_MAX_ZOOM,
+    NEAREST_MAX_K,
+)
 from funcs.user_funcs import get_current_admin, validate_token
 
 
 logger = logging.getLogger("api_logger")
 grenade_router = APIRouter(tags=["grenade"])
 
+# update_date - время начала транзакции, а видна граната становится только после коммита (например, транзакция
+# /bulk_add или ожидающая блокировку строки). Курсор сдвигается назад, чтобы такие гранаты не потерялись.
+# Повторно пришедшие гранаты клиент просто перезапишет
+CHANGES_CURSOR_OVERLAP = timedelta(seconds=60)
+BULK_ADD_LIMIT = 1000
+GRENADES_PAGE_LIMIT = 500
+SEARCH_LIMIT = 50
+
 
 @grenade_router.get(
     path="/get",
     response_model=list[GrenadePublic],
     status_code=status.HTTP_200_OK,
-    description="Эндпоинт для получения всех гранат на заданной карте",
-)
-@cache(
-    expire=60,
-    namespace="get_grenades",
-    coder=PickleCoder,
-    key_builder=custom_key_builder,
+    description="Эндпоинт для получения гранат на заданной карте, опционально с фильтрами и постранично по id",
 )
 async def get_grenades_endpoint(
     map_name: Annotated[CsMaps, Query()],
-    session: SessionDep,
+    request: Request,
+    session: ReadSessionDep,
     user_id: Annotated[
         int, Query(description="ID пользователя для проверки избранного")
     ] = -1,
+    grenade_type: Annotated[GrenadeType | None, Query(alias="type")] = None,
+    side: Annotated[GrenadeSide | None, Query()] = None,
+    difficult: Annotated[int | None, Query(ge=1, le=3)] = None,
+    after_id: Annotated[int | None, Query(description="id последней гранаты предыдущей страницы")] = None,
+    limit: Annotated[int | None, Query(ge=1, le=GRENADES_PAGE_LIMIT)] = None,
     current_admin: str = Depends(get_current_admin),
 ):
-    stm = (
-        select(Grenade, UserFavourite.date.is_not(None).label("_is_favourite"))
-        .outerjoin(
-            UserFavourite,
-            and_(
-                UserFavourite.grenade_id == Grenade.id, UserFavourite.user_id == user_id
-            ),
-        )
-        .where(and_(Grenade.map == map_name.value, Grenade.tg_post_id.is_not(None)))
-    )
-    list_of_grenades = []
-    for grenade_data in (await session.execute(stm)).all():
-        grenade = GrenadePublic.model_validate(grenade_data[0])
-        grenade.is_favourite = grenade_data[1]
-        list_of_grenades.append(grenade)
+    if any(value is not None for value in (grenade_type, side, difficult, after_id, limit)):
+        # Фильтры и пагинация выполняются в БД (индекс ix_grenades_posted_map_type_side), мимо кэша карты
+        conditions = [Grenade.map == map_name.value, Grenade.tg_post_id.is_not(None)]
+        if grenade_type is not None:
+            conditions.append(Grenade.type == grenade_type.value)
+        if side is not None:
+            conditions.append(Grenade.side == side.value)
+        if difficult is not None:
+            conditions.append(Grenade.difficult == difficult)
+        if after_id is not None:
+            conditions.append(Grenade.id > after_id)
+
+        stm = select(Grenade).where(and_(*conditions)).order_by(Grenade.id).limit(limit or GRENADES_PAGE_LIMIT)
+        grenades = [
+            GrenadePublic.model_validate(grenade)
+            for grenade in (await session.execute(stm)).unique().scalars().all()
+        ]
+
+        favourite_ids = await get_favourite_ids(user_id, map_name, session)
+        for grenade in grenades:
+            grenade.is_favourite = grenade.id in favourite_ids
+        return grenades
 
-    return list_of_grenades
+    cached = await get_map_grenades(map_name=map_name, session=session)
+    favourite_ids = await get_favourite_ids(user_id, map_name, session)
+
+    return make_cached_response(request, cached, favourite_ids)
 
 
 @grenade_router.get(
@@ -66,40 +124,152 @@ async def get_grenades_endpoint(
     status_code=status.HTTP_200_OK,
     description="Эндпоинт для получения всех гранат на заданной карте",
 )
-@cache(
-    expire=60,
-    namespace="get_grouped",
-    coder=PickleCoder,
-    key_builder=custom_key_builder,
-)
 async def get_grouped_grenades_endpoint(
     map_name: Annotated[CsMaps, Query()],
+    request: Request,
+    session: ReadSessionDep,
+    user_id: Annotated[
+        int, Query(description="ID пользователя для проверки избранного")
+    ] = -1,
+    current_token: str = Depends(validate_token),
+):
+    cached = await get_map_grouped_grenades(map_name=map_name, session=session)
+    favourite_ids = await get_favourite_ids(user_id, map_name, session)
+
+    return make_cached_response(request, cached, favourite_ids, grouped=True)
+
+
+@grenade_router.get(
+    path="/get_clusters",
+    response_model=list[GrenadeClusterPublic],
+    status_code=status.HTTP_200_OK,
+    description="Эндпоинт для получения кластеров гранат карты для заданного зума и видимой области",
+)
+async def get_grenade_clusters_endpoint(
+    map_name: Annotated[CsMaps, Query()],
+    zoom: Annotated[int, Query(ge=0, le=CLUSTER_MAX_ZOOM)],
+    session: ReadSessionDep,
+    min_top: Annotated[float | None, Query(ge=0, le=100)] = None,
+    max_top: Annotated[float | None, Query(ge=0, le=100)] = None,
+    min_left: Annotated[float | None, Query(ge=0, le=100)] = None,
+    max_left: Annotated[float | None, Query(ge=0, le=100)] = None,
+    current_token: str = Depends(validate_token),
+):
+    bbox = None
+    if any(value is not None for value in (min_top, max_top, min_left, max_left)):
+        bbox = BoundingBox(
+            min_top=min_top if min_top is not None else 0,
+            max_top=max_top if max_top is not None else 100,
+            min_left=min_left if min_left is not None else 0,
+            max_left=max_left if max_left is not None else 100,
+        )
+
+    map_grid = await get_map_index(map_name, MapGrid, session)
+    return map_grid.get_clusters(zoom, bbox)
+
+
+@grenade_router.get(
+    path="/nearest",
+    response_model=list[NearestPositionPublic],
+    status_code=status.HTTP_200_OK,
+    description="Эндпоинт для получения k ближайших к точке позиций карты и их гранат",
+)
+async def get_nearest_positions_endpoint(
+    map_name: Annotated[CsMaps, Query()],
+    top: Annotated[float, Query(ge=0, le=100)],
+    left: Annotated[float, Query(ge=0, le=100)],
+    session: ReadSessionDep,
+    k: Annotated[int, Query(ge=1, le=NEAREST_MAX_K)] = 5,
+    kind: Annotated[PositionKind, Query(description="По каким позициям искать: куда летит граната или откуда")] = (
+        PositionKind.FINAL
+    ),
+    user_id: Annotated[
+        int, Query(description="ID пользователя для проверки избранного")
+    ] = -1,
+    current_token: str = Depends(validate_token),
+):
+    index_class = PositionIndex if kind == PositionKind.FINAL else InitialPositionIndex
+    position_index = await get_map_index(map_name, index_class, session)
+    favourite_ids = await get_favourite_ids(user_id, map_name, session)
+
+    return [
+        NearestPositionPublic(
+            position=indexed_position.position,
+            distance=round(distance, 2),
+            grenades=[
+                {**grenade, "is_favourite": grenade["id"] in favourite_ids}
+                for grenade in indexed_position.grenades
+            ],
+        )
+        for distance, indexed_position in position_index.nearest(top, left, k)
+    ]
+
+
+@grenade_router.get(
+    path="/search",
+    response_model=list[SearchResultPublic],
+    status_code=status.HTTP_200_OK,
+    description="Нечёткий поиск по названиям позиций, комбинациям клавиш и описаниям гранат",
+)
+async def search_endpoint(
+    q: Annotated[str, Query(min_length=2, max_length=100)],
+    session: ReadSessionDep,
+    map_name: Annotated[CsMaps | None, Query()] = None,
+    limit: Annotated[int, Query(ge=1, le=SEARCH_LIMIT)] = 10,
+    current_token: str = Depends(validate_token),
+):
+    return await search_catalogue(q, map_name, limit, session)
+
+
+@grenade_router.get(
+    path="/changes",
+    response_model=GrenadeChangesPublic,
+    status_code=status.HTTP_200_OK,
+    description="Эндпоинт для получения гранат карты, изменённых или удалённых после курсора since",
+)
+async def get_grenade_changes_endpoint(
+    map_name: Annotated[CsMaps, Query()],
+    since: Annotated[datetime, Query(description="Курсор из предыдущего ответа")],
     session: SessionDep,
     user_id: Annotated[
         int, Query(description="ID пользователя для проверки избранного")
     ] = -1,
     current_token: str = Depends(validate_token),
 ):
-    stm = (
-        select(Grenade, UserFavourite.date.isnot(None).label("_is_favourite"))
-        .outerjoin(
-            UserFavourite,
-            and_(
-                UserFavourite.grenade_id == Grenade.id, UserFavourite.user_id == user_id
-            ),
+    # update_date хранится без зоны во времени сессии БД. Курсор с зоной переводится в это время на стороне БД,
+    # курсор без зоны (из предыдущего ответа) уже в нём
+    since_at = cast(literal(since, DateTime(timezone=True)), DateTime) if since.tzinfo else since
+
+    # Курсор берётся из времени БД, чтобы не зависеть от часов клиента
+    cursor = (await session.execute(select(func.localtimestamp()))).scalar()
+
+    stm = select(Grenade).where(
+        and_(
+            Grenade.map == map_name.value,
+            Grenade.tg_post_id.is_not(None),
+            Grenade.update_date > since_at,
         )
-        .where(and_(Grenade.map == map_name.value, Grenade.tg_post_id.is_not(None)))
     )
+    grenades = [
+        GrenadePublic.model_validate(grenade)
+        for grenade in (await session.execute(stm)).scalars().all()
+    ]
 
-    dict_of_grenades: dict[str, dict[int, GrenadePublic]] = {}
-    for grenade_data in (await session.execute(stm)).all():
-        grenade = GrenadePublic.model_validate(grenade_data[0])
-        grenade.is_favourite = grenade_data[1]
+    stm = select(GrenadeTombstone.grenade_id).where(
+        and_(GrenadeTombstone.map == map_name.value, GrenadeTombstone.delete_date > since_at)
+    )
+    changed_ids = {grenade.id for grenade in grenades}
+    deleted_ids = set((await session.execute(stm)).scalars().all()) - changed_ids
 
-        key = f"{grenade.final_position.position.top}_{grenade.final_position.position.left}"
-        dict_of_grenades.setdefault(key, {})[grenade.id] = grenade
+    favourite_ids = await get_favourite_ids(user_id, map_name, session)
+    for grenade in grenades:
+        grenade.is_favourite = grenade.id in favourite_ids
 
-    return dict_of_grenades
+    return GrenadeChangesPublic(
+        grenades=grenades,
+        deleted_ids=sorted(deleted_ids),
+        cursor=cursor - CHANGES_CURSOR_OVERLAP,
+    )
 
 
 @grenade_router.post(
@@ -115,109 +285,131 @@ async def get_grouped_grenades_endpoint(
 async def add_grenade_endpoint(
     new_grenade: NewGrenade,
     session: SessionDep,
-    queue: QueueDep,
     current_admin: str = Depends(get_current_admin),
 ):
+    if await has_active_post_job(new_grenade.id, session):
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Пост для гранаты [ID: {new_grenade.id}] ещё создаётся или изменяется",
+        )
+
     response_messages = []
     grenade = await process_grenade_data(new_grenade, session)
     response_messages.append(f'[+] Граната "{grenade.type.value}" [ID: {grenade.id}]')
 
-    logger.info("Sending job [make_post] to worker...")
-    dumped_model = grenade.model_dump(
-        mode="json",
-        include={
-            "id",
-            "type",
-            "side",
-            "difficult",
-            "tg_post_id",
-            "data",
-            "tg_data",
-            "map",
-        },
-    )
-    dumped_model["initial_position"] = grenade.initial_position.model_dump(mode="json")
-    dumped_model["final_position"] = grenade.final_position.model_dump(mode="json")
-    dumped_model["key_combo"] = grenade.key_combo.model_dump(mode="json")
+    # Пост создаётся в фоне: граната и задача коммитятся вместе, tg_post_id проставит диспетчер outbox
+    post_job = await add_post_job(grenade, "create_grenade_post", session)
+    await commit_and_invalidate(session)
+    notify_outbox()
+    response_messages.append(f"[+] Задача на пост в телеграм [ID: {post_job.id}] создана.")
 
-    job = await queue.enqueue_job(
-        "create_grenade_post", dumped_model, _job_id=f"create_grenade_{grenade.id}"
-    )
-    try:
-        job_data: CreateGrenadeJobResponse = await job.result(timeout=30)
-        logger.info("Job [make_post] completed")
-        response_messages.append(
-            f"[+] Пост телеграм ID: [{job_data['tg_post_id']}] добавлен."
-        )
-    except SerializationError:
-        await session.rollback()  # откатываем всё
+    return {"message": " ".join(response_messages), "job_id": post_job.id}
+
+
+@grenade_router.post(
+    path="/bulk_add",
+    status_code=status.HTTP_201_CREATED,
+    description="Эндпоинт для пакетного добавления гранат одной транзакцией (например, при заполнении новой карты)",
+    responses={
+        201: {"description": "Гранаты успешно добавлены"},
+        409: {"description": "Конфликт данных, нужно проверять ответ сервера"},
+        422: {"description": "Ошибка валидации входных параметров"},
+    },
+)
+async def bulk_add_grenades_endpoint(
+    new_grenades: Annotated[list[NewGrenade], Body(min_length=1, max_length=BULK_ADD_LIMIT)],
+    session: SessionDep,
+    current_admin: str = Depends(get_current_admin),
+):
+    active_ids = await get_active_post_job_grenade_ids([new_grenade.id for new_grenade in new_grenades], session)
+    if active_ids:
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Граната [ID: {grenade.id}] не добавлена. Произошла ошибка при создании поста в телеграм",
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Посты для гранат [ID: {sorted(active_ids)}] ещё создаются или изменяются",
         )
 
-    grenade.tg_post_id = job_data["tg_post_id"]
-    grenade.tg_data.setup_photo_msg_id = job_data["setup_photo_msg_id"]
-    grenade.tg_data.finish_photo_msg_id = job_data["finish_photo_msg_id"]
-    flag_modified(grenade, "tg_data")
-    session.add(grenade)
-    await session.commit()
-    return {"message": " ".join(response_messages)}
+    grenades = await bulk_process_grenade_data(new_grenades, session)
+    post_jobs = await add_post_jobs(grenades, session)
+    await commit_and_invalidate(session)
+    notify_outbox()
+
+    return {
+        "message": f"[+] Гранат: {len(grenades)}. Задач на посты в телеграм: {len(post_jobs)}.",
+        "job_ids": [post_job.id for post_job in post_jobs],
+    }
 
 
 @grenade_router.post(
     path="/edit",
     status_code=status.HTTP_200_OK,
     description="Эндпоинт для изменения гранаты",
+    responses={
+        200: {"description": "Граната успешно изменена"},
+        409: {"description": "Пост гранаты ещё создаётся или изменяется, нужно повторить позже"},
+        422: {"description": "Ошибка валидации входных параметров"},
+    },
 )
 async def edit_grenade_endpoint(
     new_grenade: NewGrenade,
     session: SessionDep,
-    queue: QueueDep,
     current_admin: str = Depends(get_current_admin),
 ):
+    if await has_active_post_job(new_grenade.id, session):
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Пост для гранаты [ID: {new_grenade.id}] ещё создаётся или изменяется",
+        )
+
     response_messages = []
     grenade = await process_grenade_data(new_grenade, session)
     response_messages.append(
         f'[o] Граната "{grenade.type.value}" [ID: {grenade.id}] обновлена.'
     )
 
-    logger.info("Sending job [edit_post] to worker...")
-    dumped_model = grenade.model_dump(
-        mode="json",
-        include={
-            "id",
-            "type",
-            "side",
-            "difficult",
-            "tg_post_id",
-            "data",
-            "tg_data",
-            "map",
-        },
+    post_job = await add_post_job(grenade, "edit_grenade_post", session)
+    await commit_and_invalidate(session)
+    notify_outbox()
+    response_messages.append(
+        f"[o] Задача на изменение поста телеграм ID: [{grenade.tg_post_id}] создана [ID: {post_job.id}]."
     )
-    dumped_model["initial_position"] = grenade.initial_position.model_dump(mode="json")
-    dumped_model["final_position"] = grenade.final_position.model_dump(mode="json")
-    dumped_model["key_combo"] = grenade.key_combo.model_dump(mode="json")
 
-    job = await queue.enqueue_job(
-        "edit_grenade_post", dumped_model, _job_id=f"edit_grenade_{grenade.id}"
-    )
-    try:
-        await job.result(timeout=30)
-        logger.info("Job [edit_post] completed")
-        response_messages.append(
-            f"[o] Пост телеграм ID: [{grenade.tg_post_id}] измененён."
-        )
-    except SerializationError:
-        await session.rollback()  # откатываем всё
+    return {"message": " ".join(response_messages), "job_id": post_job.id}
+
+
+@grenade_router.get(
+    path="/post_job",
+    response_model=GrenadePostJobPublic,
+    status_code=status.HTTP_200_OK,
+    description="Эндпоинт для получения статуса задачи на пост в телеграм",
+)
+async def get_post_job_endpoint(
+    job_id: Annotated[int, Query()],
+    session: SessionDep,
+    current_admin: str = Depends(get_current_admin),
+):
+    post_job = await session.get(GrenadePostJob, job_id)
+    if post_job is None:
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Граната [ID: {grenade.id}] не изменена. Произошла ошибка при редактировании поста в телеграм",
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Задача [ID: {job_id}] не найдена",
         )
 
-    await session.commit()
-    return {"message": " ".join(response_messages)}
+    return post_job
+
+
+@grenade_router.get(
+    path="/favourites",
+    response_model=list[int],
+    status_code=status.HTTP_200_OK,
+    description="Эндпоинт для получения ID избранных гранат юзера, опционально на заданной карте",
+)
+async def get_favourites_endpoint(
+    user_id: Annotated[int, Query()],
+    session: ReadSessionDep,
+    map_name: Annotated[CsMaps | None, Query()] = None,
+    current_token: str = Depends(validate_token),
+):
+    return sorted(await get_favourite_ids(user_id, map_name, session))
 
 
 @grenade_router.post(
@@ -244,12 +436,69 @@ async def add_grenade_to_favourite(
             status_code=status.HTTP_304_NOT_MODIFIED,
             detail="User_id or grenade_id not found",
         )
+    await invalidate_user_favourites(user_id)
 
     return {
         "message": f"Grenade [ID: {grenade_id}] added to favourite for user [ID: {user_id}"
     }
 
 
+@grenade_router.post(
+    path="/favourites/batch",
+    response_model=list[FavouriteOperationResult],
+    status_code=status.HTTP_200_OK,
+    description="Эндпоинт для пакетного добавления/удаления гранат в/из избранного одной транзакцией",
+)
+async def batch_favourites_endpoint(
+    batch: FavouriteBatch,
+    session: SessionDep,
+    current_token: str = Depends(validate_token),
+):
+    # Для повторяющейся гранаты учитывается последняя операция
+    operations = {operation.grenade_id: operation.action for operation in batch.operations}
+    to_add = [grenade_id for grenade_id, action in operations.items() if action == FavouriteAction.ADD]
+    to_remove = [grenade_id for grenade_id, action in operations.items() if action == FavouriteAction.REMOVE]
+
+    applied: set[int] = set()
+    try:
+        if to_add:
+            # Несуществующие гранаты отсеиваются через SELECT, чтобы не ронять всю пачку на внешнем ключе
+            stm = (
+                insert(UserFavourite)
+                .from_select(
+                    ["user_id", "grenade_id", "date"],
+                    select(literal(batch.user_id, BigInteger), Grenade.id, func.now()).where(Grenade.id.in_(to_add)),
+                )
+                .on_conflict_do_nothing()
+                .returning(UserFavourite.grenade_id)
+            )
+            applied.update((await session.execute(stm)).scalars().all())
+
+        if to_remove:
+            stm = (
+                delete(UserFavourite)
+                .where(
+                    and_(UserFavourite.user_id == batch.user_id, UserFavourite.grenade_id.in_(to_remove))
+                )
+                .returning(UserFavourite.grenade_id)
+            )
+            applied.update((await session.execute(stm)).scalars().all())
+
+        await session.commit()
+    except IntegrityError:
+        await session.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_304_NOT_MODIFIED,
+            detail="User_id not found",
+        )
+    await invalidate_user_favourites(batch.user_id)
+
+    return [
+        FavouriteOperationResult(grenade_id=grenade_id, action=action, applied=grenade_id in applied)
+        for grenade_id, action in operations.items()
+    ]
+
+
 @grenade_router.delete(
     path="/remove_from_favourite",
     status_code=status.HTTP_200_OK,
@@ -266,6 +515,7 @@ async def endpoint_for_remove_from_favourite(
     )
     await session.execute(stm)
     await session.commit()
+    await invalidate_user_favourites(user_id)
 
     return {
         "message": f"Grenade [ID: {grenade_id}] removed from favourite for user [ID: {user_id}"
@@ -6,11 +6,13 @@ from config import CONFIG
 from db.models import NewUser, UserRawData, UserData
 from dependencies import SessionDep
 from funcs.user_funcs import (
-    add_or_update_user,
     check_webapp_signature,
     parse_webapp_init_data,
     create_access_token,
+    get_recent_is_subscribed,
+    remember_webapp_data,
 )
+from funcs.user_write_funcs import save_user
 
 
 logger = logging.getLogger("api_logger")
@@ -25,26 +27,30 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 1440
     description="Эндпоинт для добавления и обновления юзера",
 )
 async def create_or_update_user(data: UserRawData, session: SessionDep):
-    if not check_webapp_signature(CONFIG.bot_token, data.data):
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Несанкционированный доступ",
-        )
+    # Тот же initData недавно уже проверен и записан в БД
+    is_subscribed = get_recent_is_subscribed(data.data)
+    if is_subscribed is None:
+        if not check_webapp_signature(CONFIG.bot_token, data.data):
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Несанкционированный доступ",
+            )
 
-    user_data = parse_webapp_init_data(data.data)
-    is_subscribed = await add_or_update_user(
-        new_user=NewUser(
-            id=user_data["user"]["id"],
-            username=user_data["user"].get("username"),
-            user_data=UserData(
-                language_code=user_data["user"].get("language_code"),
-                name=user_data["user"].get("first_name", "") + " " + user_data["user"].get("last_name", ""),
+        user_data = parse_webapp_init_data(data.data)
+        # Неизменённые данные не пишутся, изменения пишутся пачками фоновым flusher-ом
+        is_subscribed = await save_user(
+            new_user=NewUser(
+                id=user_data["user"]["id"],
+                username=user_data["user"].get("username"),
+                user_data=UserData(
+                    language_code=user_data["user"].get("language_code"),
+                    name=user_data["user"].get("first_name", "") + " " + user_data["user"].get("last_name", ""),
+                ),
+                invite_url=user_data.get("start_param"),
             ),
-            invite_url=user_data.get("start_param"),
-        ),
-        session=session,
-    )
-    await session.commit()
+            session=session,
+        )
+        remember_webapp_data(data.data, is_subscribed)
 
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(